@@ -0,0 +1,345 @@
+# BeautifulSoup documents for the spiders' extractors, built with the tree builder chosen by
+# the PARSE_ENGINE setting from the page regions the spider declares, a parse-once context that
+# memoizes the extractors' work on one response, a one-pass index of the sections nodes are in,
+# and a parity test mode to check a faster engine or the regions against a full reference
+# parse before a spider switches to them
+#
+# See documentation in:
+# https://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser
+# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+import functools
+import inspect
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import zip_longest
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from itemadapter import ItemAdapter, is_item
+from scrapy import Spider
+from scrapy.exceptions import NotConfigured
+from parsel.csstranslator import HTMLTranslator
+from scrapy.http import Response, TextResponse
+from scrapy.utils.spider import iterate_spider_output
+
+from course_crawler.utils import callback_name
+
+
+# the builder every extractor was written against
+REFERENCE_ENGINE = 'html.parser'
+
+_UNSET = object()
+
+_engine_override: ContextVar[Optional[str]] = ContextVar('parse_engine_override', default=None)
+_regions_override: ContextVar = ContextVar('parse_regions_override', default=_UNSET)
+
+
+def parse_engine(spider: Optional[Spider]) -> str:
+    """The tree builder for `spider`'s documents: PARSE_ENGINE from its (custom) settings."""
+    engine = _engine_override.get()
+    if engine is None and spider is not None:
+        engine = spider.settings.get('PARSE_ENGINE')
+    return engine or REFERENCE_ENGINE
+
+
+def parse_regions(response: Response, spider: Optional[Spider]) -> Optional[List[str]]:
+    """The regions of `response` its callback declares in the spider's `parse_regions`, if any."""
+    regions = _regions_override.get()
+    if regions is _UNSET:
+        regions = None
+        if spider is not None and response.request is not None:
+            regions = getattr(spider, 'parse_regions', {}).get(callback_name(response.request))
+    return regions or None
+
+
+@contextmanager
+def forced_parse(engine: str, regions: Optional[List[str]] = None):
+    """Makes the documents parsed in this context use `engine` and `regions` (None for the whole
+    page), whatever the spider declares."""
+    engine_token = _engine_override.set(engine)
+    regions_token = _regions_override.set(regions)
+    try:
+        yield
+    finally:
+        _regions_override.reset(regions_token)
+        _engine_override.reset(engine_token)
+
+
+class OptionalRegion(str):
+    """A region of `parse_regions` that only some pages have, e.g. a fee table; a page without
+    it is still cut down to the other regions."""
+
+
+@lru_cache(maxsize=256)
+def _xpath(selector: str) -> str:
+    return HTMLTranslator().css_to_xpath(selector)
+
+
+def _regions_html(response: Response, regions: List[str]) -> Optional[str]:
+    if not isinstance(response, TextResponse):
+        return None
+    paths = [_xpath(region) for region in regions]
+    required = [path for region, path in zip(regions, paths) if not isinstance(region, OptionalRegion)]
+    if not all(response.xpath(path) for path in required):
+        return None
+    # a union comes in document order, regions nested in other regions are already in them
+    elements = response.xpath(' | '.join(paths))
+    roots = {element.root for element in elements}
+    return ''.join(
+        element.get() for element in elements
+        if not any(ancestor in roots for ancestor in element.root.iterancestors())
+    )
+
+
+def _count(spider: Optional[Spider], key: str) -> None:
+    if getattr(spider, 'crawler', None) is not None:
+        spider.crawler.stats.inc_value(key, spider=spider)
+
+
+def make_soup(response: Response, spider: Optional[Spider] = None) -> BeautifulSoup:
+    """
+    Parses `response` for the extractors. Every engine gives the same BeautifulSoup API
+    (`select`, `select_one`, `find_previous`, `get_text`, `prettify`, ...); 'lxml' builds the
+    tree in C and is several times faster than 'html.parser', but repairs broken markup its own
+    way, so check a spider with PARSE_ENGINE_PARITY before switching it.
+
+    A spider that declares the regions its extractors read, as CSS selectors by callback,
+
+        parse_regions = {'parse_course': ['#overview', '#entry-requirements', 'div.pb-5']}
+
+    gets a document of only those subtrees, in page order, cut from the response's own
+    (C-built) selector tree; a region nested in another one comes with it. Navigation, footers
+    and scripts are never built into the soup. When a region is missing from the page, the
+    page is parsed in full, unless the region is an OptionalRegion('table.fees'). Counted in
+    the documents/partial and documents/partial_fallback stats.
+
+    Extractors only see the regions: anything they look up around a node, such as the heading
+    before it, must be inside the node's region.
+    """
+    engine = parse_engine(spider)
+    regions = parse_regions(response, spider)
+    if regions:
+        html = _regions_html(response, regions)
+        if html is not None:
+            _count(spider, 'documents/partial')
+            return BeautifulSoup(f"<html><body>{html}</body></html>", engine)
+        _count(spider, 'documents/partial_fallback')
+    return BeautifulSoup(response.body, engine, from_encoding='utf-8')
+
+
+class SectionIndex:
+    """
+    The sections every element of a document is in, found in one walk over the document instead
+    of a `find_previous` scan per element. Each marker is a tag name, a tuple of names or a
+    SoupStrainer, as `find_previous` takes them:
+
+        sections = SectionIndex(soup, variant=SoupStrainer('div', class_='variant'), type='h5')
+        sections.nearest(module, 'type')  # module.find_previous('h5'), None when there is none
+
+    `nearest` gives the last element matching the marker before the node in document order,
+    its ancestors included, as `find_previous` does. The index is of the tree as it was built.
+    """
+
+    def __init__(self, soup, **markers):
+        self.names = {name: position for position, name in enumerate(markers)}
+        matchers = [self._matcher(marker) for marker in markers.values()]
+        self.previous: Dict[int, Tuple[Optional[Tag], ...]] = {}
+        # the nodes between two marker elements share one tuple
+        current = (None,) * len(matchers)
+        for node in soup.descendants:
+            if not isinstance(node, Tag):
+                continue
+            self.previous[id(node)] = current
+            matches = [matcher(node) for matcher in matchers]
+            if any(matches):
+                current = tuple(node if match else last for match, last in zip(matches, current))
+
+    @staticmethod
+    def _matcher(marker) -> Callable[[Tag], bool]:
+        if isinstance(marker, SoupStrainer):
+            return lambda node: bool(marker.search(node))
+        names = {marker} if isinstance(marker, str) else set(marker)
+        return lambda node: node.name in names
+
+    def nearest(self, node: Tag, marker: str) -> Optional[Tag]:
+        return self.previous[id(node)][self.names[marker]]
+
+
+_MISSING = object()
+
+
+class Document:
+    """
+    Parse-once context of a response, handed to its extractors in place of the soup. `select`
+    and `select_one` are memoized by selector, `node_text` (the stripped text of a node) by
+    node, `sections` (a SectionIndex) by its markers and the outputs of extractors decorated
+    with `memoized` by their arguments; anything else is the soup's own:
+
+        soup = Document(response, self)
+
+        @memoized
+        def _get_tuitions(self, soup, criteria): ...
+
+    Memoized values are shared between the callers, which must not modify them; an extractor
+    that changes the tree calls `invalidate()`. Hits and misses are counted in the
+    document_cache/hits/<kind> and document_cache/misses/<kind> stats.
+    """
+
+    def __init__(self, response: Response, spider: Optional[Spider] = None):
+        self.soup = make_soup(response, spider)
+        self.spider = spider
+        self.stats = spider.crawler.stats if getattr(spider, 'crawler', None) is not None else None
+        self.cache = {}
+
+    def __getattr__(self, name):
+        return getattr(self.soup, name)
+
+    def memo(self, kind: str, key, compute: Callable):
+        try:
+            value = self.cache.get((kind, key), _MISSING)
+        except TypeError:
+            # unhashable arguments are not memoized
+            return compute()
+        if value is _MISSING:
+            value = self.cache[kind, key] = compute()
+            self._count('misses', kind)
+        else:
+            self._count('hits', kind)
+        return value
+
+    def _count(self, outcome: str, kind: str) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(f"document_cache/{outcome}/{kind}", spider=self.spider)
+
+    def invalidate(self) -> None:
+        self.cache.clear()
+
+    def select(self, selector: str) -> List[Tag]:
+        return list(self.memo('select', selector, lambda: self.soup.select(selector)))
+
+    def select_one(self, selector: str) -> Optional[Tag]:
+        return self.memo('select_one', selector, lambda: self.soup.select_one(selector))
+
+    def node_text(self, node: Tag) -> str:
+        # the node is kept with its text so that its id is not reused while the entry exists
+        return self.memo('node_text', id(node), lambda: (node, node.get_text().strip()))[1]
+
+    def sections(self, **markers) -> SectionIndex:
+        # built once for markers given as the same objects on every call
+        return self.memo('sections', tuple(markers.items()), lambda: SectionIndex(self.soup, **markers))
+
+
+def memoized(extractor: Callable) -> Callable:
+    """Memoizes a spider's `extractor(self, soup, *args)` on the Document it is given, by its
+    arguments. Called with a plain soup, the extractor just runs."""
+
+    @functools.wraps(extractor)
+    def wrapper(self, document, *args, **kwargs):
+        if not isinstance(document, Document):
+            return extractor(self, document, *args, **kwargs)
+        key = (extractor.__name__, args, tuple(sorted(kwargs.items())))
+        return document.memo('extractor', key, lambda: extractor(self, document, *args, **kwargs))
+
+    return wrapper
+
+
+def _snapshot(item) -> dict:
+    return json.loads(json.dumps(ItemAdapter(item).asdict(), default=str))
+
+
+class ParseParityMiddleware:
+    """
+    Parity test mode for a spider's PARSE_ENGINE and `parse_regions`, enabled with
+    PARSE_ENGINE_PARITY = True.
+
+    For every response that produced items, the extractor is run again on a full parse with the
+    reference engine (html.parser) once the callback is done, and the two sets of items are
+    compared field by field. The extractor is the method a callback hands to `extract` (run
+    inline, not in the extraction pool), or else the callback itself when it is a plain function.
+    Coroutine callbacks that do not go through `extract` may download sub-requests (Harper's
+    modules, ...), which a second run would fetch again; they are not compared, counted in
+    parse_parity/skipped and logged once per callback.
+
+    Differences are logged as warnings and counted in the parse_parity/mismatches and
+    parse_parity/field/<name> stats, compared pages in parse_parity/pages. Requests the second
+    run yields are dropped, the crawl itself only follows the spider's engine.
+    """
+
+    def __init__(self, crawler):
+        if not crawler.settings.getbool('PARSE_ENGINE_PARITY'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.skipped = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        engine = parse_engine(spider)
+        if parse_regions(response, spider):
+            engine = f"{engine} on regions"
+        elif engine == REFERENCE_ENGINE:
+            yield from result
+            return
+
+        items = []
+        for element in result:
+            if is_item(element):
+                # snapshot before the item pipelines get to modify it
+                items.append(_snapshot(element))
+            yield element
+
+        if not items:
+            return
+        extractor = self._extractor(response, spider)
+        if extractor is None:
+            self.stats.inc_value('parse_parity/skipped', spider=spider)
+            callback = callback_name(response.request)
+            if callback not in self.skipped:
+                self.skipped.add(callback)
+                spider.logger.warning(
+                    'Parse parity does not compare the items of %s, a coroutine callback that does not '
+                    'call extract', callback,
+                )
+            return
+        self._compare(response, engine, items, extractor, spider)
+
+    @staticmethod
+    def _extractor(response, spider) -> Optional[Callable]:
+        method = response.meta.get('extraction_method')
+        if method is not None:
+            return getattr(spider, method)
+        request = response.request
+        callback = request.callback or spider.parse
+        if inspect.iscoroutinefunction(callback) or inspect.isasyncgenfunction(callback):
+            return None
+        return functools.partial(callback, **request.cb_kwargs)
+
+    @staticmethod
+    def _reference_items(response, extractor) -> list:
+        with forced_parse(REFERENCE_ENGINE):
+            return [_snapshot(element) for element in iterate_spider_output(extractor(response)) if is_item(element)]
+
+    def _compare(self, response, engine, items, extractor, spider):
+        try:
+            reference = self._reference_items(response, extractor)
+        except Exception:
+            spider.logger.error('Could not parse %s with %s', response.url, REFERENCE_ENGINE, exc_info=True)
+            return
+        self.stats.inc_value('parse_parity/pages', spider=spider)
+        if items == reference:
+            return
+
+        fields = set()
+        for item, expected in zip_longest(items, reference, fillvalue={}):
+            fields |= {name for name in item.keys() | expected.keys() if item.get(name) != expected.get(name)}
+        self.stats.inc_value('parse_parity/mismatches', spider=spider)
+        for name in fields:
+            self.stats.inc_value(f"parse_parity/field/{name}", spider=spider)
+        spider.logger.warning(
+            '%s and %s extract different items from %s (%i against %i items, fields: %s)',
+            engine, REFERENCE_ENGINE, response.url, len(items), len(reference), ', '.join(sorted(fields)),
+        )
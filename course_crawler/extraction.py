@@ -0,0 +1,185 @@
+# Extraction of course pages in a pool of worker processes, so that parsing does not block the
+# reactor (and with it downloads, timeouts and the Playwright connection) and one crawl can
+# parse on every core
+#
+# See documentation in:
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+# https://docs.scrapy.org/en/latest/topics/coroutines.html
+import asyncio
+import multiprocessing
+import os
+import pickle
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from typing import List, Tuple
+
+from itemadapter import is_item
+from scrapy import Spider, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.utils.spider import iterate_spider_output
+
+from course_crawler.documents import forced_parse, parse_engine, parse_regions
+
+
+def _items(spider: Spider, method: str, response: Response) -> list:
+    return [element for element in iterate_spider_output(getattr(spider, method)(response)) if is_item(element)]
+
+
+def _state(spider: Spider) -> dict:
+    # what the extractors read from the spider besides its class attributes
+    attributes = [resource.attribute for resource in getattr(spider, 'reference_resources', [])]
+    attributes += getattr(spider, 'extraction_attributes', [])
+    return {attribute: getattr(spider, attribute) for attribute in attributes if hasattr(spider, attribute)}
+
+
+def _plain_meta(meta: dict) -> dict:
+    plain = {}
+    for key, value in meta.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            # Playwright pages, errbacks, ...
+            continue
+        plain[key] = value
+    return plain
+
+
+class _Counts(Counter):
+    """The crawler stats of a worker's spider: what the extractors count (document_cache/*, ...),
+    sent back with their items."""
+
+    def inc_value(self, key, count=1, start=0, spider=None):
+        self[key] += count
+
+
+# spiders of a worker process, by class
+_spiders = {}
+
+
+def _extract(spidercls, state, engine, regions, method, url, body, encoding, meta) -> Tuple[list, dict]:
+    spider = _spiders.get(spidercls)
+    if spider is None:
+        spider = _spiders[spidercls] = spidercls()
+    for attribute, value in state.items():
+        setattr(spider, attribute, value)
+    counts = _Counts()
+    spider.crawler = SimpleNamespace(stats=counts)
+    response = HtmlResponse(url, body=body, encoding=encoding, request=Request(url, meta=meta))
+    with forced_parse(engine, regions):
+        return _items(spider, method, response), dict(counts)
+
+
+async def extract(spider: Spider, response: Response, method: str) -> List[dict]:
+    """
+    Returns the items of `spider.<method>(response)`, an extractor that only reads the response
+    and yields items, computed by the extraction pool when it is enabled and inline otherwise:
+
+        async def parse_course(self, response):
+            for item in await extract(self, response, '_extract_course'):
+                yield item
+
+    In the pool, the extractor runs on a copy of the spider that has its class attributes, the
+    values of its `reference_resources` and any attributes listed in `extraction_attributes`,
+    and the response has the request's picklable meta.
+    """
+    # lets the parse parity mode compare engines on the extractor alone
+    response.meta['extraction_method'] = method
+    pool = getattr(spider, 'extraction_pool', None)
+    if pool is None:
+        return _items(spider, method, response)
+    return await pool.run(spider, response, method)
+
+
+class ExtractionPool:
+    """
+    Runs `extract` calls in EXTRACTION_POOL_WORKERS processes (all cores by default), shared by
+    the crawlers of the process. No more than EXTRACTION_POOL_MAX_PENDING responses of a crawler
+    are queued for the workers, the callbacks of the others wait; responses waiting in callbacks
+    fill the scraper slot, which stops the engine from taking more requests off the scheduler.
+
+    The stats the extractors count in the workers are added to the crawler's. When a worker dies
+    (out of memory, ...) the pool is replaced and the page is submitted once more; pool restarts
+    are counted in extraction/restarts. Pages are counted in the extraction/pages stat,
+    extraction/max_pending is the longest queue.
+    """
+
+    executor = None
+    users = 0
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('EXTRACTION_POOL_ENABLED'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.workers = settings.getint('EXTRACTION_POOL_WORKERS') or os.cpu_count() or 1
+        self.max_pending = settings.getint('EXTRACTION_POOL_MAX_PENDING') or 2 * self.workers
+        self.semaphore = None
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    @classmethod
+    def _executor(cls, workers: int) -> ProcessPoolExecutor:
+        if cls.executor is None:
+            # workers must not inherit the reactor and the browser connection
+            cls.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        return cls.executor
+
+    def spider_opened(self, spider):
+        self._executor(self.workers)
+        ExtractionPool.users += 1
+        spider.extraction_pool = self
+
+    def spider_closed(self, spider):
+        ExtractionPool.users -= 1
+        if not ExtractionPool.users and ExtractionPool.executor is not None:
+            ExtractionPool.executor.shutdown(wait=False, cancel_futures=True)
+            ExtractionPool.executor = None
+
+    @classmethod
+    def _restart(cls, executor: ProcessPoolExecutor) -> bool:
+        # every page in flight on a broken pool fails with it, the first one replaces it
+        if cls.executor is not executor:
+            return False
+        executor.shutdown(wait=False, cancel_futures=True)
+        cls.executor = None
+        return True
+
+    async def _submit(self, spider: Spider, response: Response, method: str) -> Tuple[list, dict]:
+        args = (
+            _extract, type(spider), _state(spider), parse_engine(spider),
+            parse_regions(response, spider), method,
+            response.url, response.body, response.encoding, _plain_meta(response.meta),
+        )
+        executor = self._executor(self.workers)
+        try:
+            return await asyncio.wrap_future(executor.submit(*args))
+        except BrokenProcessPool:
+            spider.logger.error('Extraction pool broke on %s, submitting it to a new pool', response.url)
+            if self._restart(executor):
+                self.stats.inc_value('extraction/restarts', spider=spider)
+        # a page that breaks the new pool as well fails its callback
+        return await asyncio.wrap_future(self._executor(self.workers).submit(*args))
+
+    async def run(self, spider: Spider, response: Response, method: str) -> List[dict]:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_pending)
+        async with self.semaphore:
+            self.pending += 1
+            self.stats.max_value('extraction/max_pending', self.pending, spider=spider)
+            try:
+                items, counts = await self._submit(spider, response, method)
+            finally:
+                self.pending -= 1
+        for key, count in counts.items():
+            self.stats.inc_value(key, count, spider=spider)
+        self.stats.inc_value('extraction/pages', spider=spider)
+        return items
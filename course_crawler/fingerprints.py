@@ -0,0 +1,299 @@
+# Fingerprints of the requests and items seen by previous runs, kept on disk per spider and
+# looked up without loading them
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/request-response.html#request-fingerprints
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import data_path
+from scrapy.utils.python import to_unicode
+from w3lib.url import canonicalize_url
+
+
+FINGERPRINT_SIZE = 20
+
+
+def fingerprint(request) -> bytes:
+    """The fingerprint of `request` under REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7", as a
+    20-byte digest. Computed here as well, so it does not change when Scrapy is upgraded."""
+    data = {
+        'method': to_unicode(request.method),
+        'url': canonicalize_url(request.url),
+        'body': (request.body or b'').hex(),
+        'headers': {},
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).digest()
+
+
+def item_fingerprint(item) -> bytes:
+    """20-byte digest of the fields of `item`, equal for items with equal content."""
+    data = json.dumps(ItemAdapter(item).asdict(), sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).digest()
+
+
+class BloomFilter:
+    """Bit array answering "maybe seen" or "never seen" for fingerprints, which are uniform digests."""
+
+    HEADER = struct.Struct('<QQQ')
+
+    def __init__(self, bits: int, hashes: int, data: Optional[bytes] = None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float) -> 'BloomFilter':
+        bits = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        return cls(bits, max(1, round(bits / capacity * math.log(2))))
+
+    @classmethod
+    def load(cls, path: Path) -> Tuple[Optional['BloomFilter'], int]:
+        """Returns the filter saved at `path` and the number of log records it covers."""
+        try:
+            data = path.read_bytes()
+            bits, hashes, count = cls.HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return None, 0
+        if len(data) != cls.HEADER.size + (bits + 7) // 8:
+            return None, 0
+        return cls(bits, hashes, data[cls.HEADER.size:]), count
+
+    def save(self, path: Path, count: int) -> None:
+        temp = path.with_suffix('.tmp')
+        with temp.open('wb') as f:
+            f.write(self.HEADER.pack(self.bits, self.hashes, count))
+            f.write(self.data)
+        os.replace(temp, path)
+
+    def _positions(self, fp: bytes) -> Iterator[int]:
+        # double hashing over two halves of the digest
+        h1 = int.from_bytes(fp[:8], 'little')
+        h2 = int.from_bytes(fp[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, fp: bytes) -> None:
+        for position in self._positions(fp):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fp: bytes) -> bool:
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(fp))
+
+
+class FingerprintStore:
+    """
+    Set of 20-byte fingerprints kept in three files next to `path`:
+
+    * <path>.log: the fingerprints, appended in the order they were added and never rewritten
+    * <path>.idx: open-addressing hash table of log record numbers, memory-mapped
+    * <path>.bloom: Bloom filter in front of the table, sized for `capacity` fingerprints
+
+    A lookup checks the Bloom filter, then probes the table and compares the candidates with
+    their log records, so there are no false positives and the fingerprints are never all in
+    memory. The table and the filter are rebuilt from the log when they are missing, outgrown
+    or were not closed cleanly; a record cut short by a crash is dropped. One process may have
+    a store open at a time.
+    """
+
+    INDEX_HEADER = struct.Struct('<QQ')
+    SLOT = struct.Struct('<Q')
+    MIN_SLOTS = 1024
+
+    def __init__(self, path, capacity: int = 1_000_000, error_rate: float = 0.01):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.log = self._file('.log').open('a+b')
+        size = os.fstat(self.log.fileno()).st_size
+        if size % FINGERPRINT_SIZE:
+            self.log.truncate(size - size % FINGERPRINT_SIZE)
+        self.count = size // FINGERPRINT_SIZE
+        self.index = None
+        self.slots = 0
+        self._open_index()
+        self._open_bloom()
+
+    def _file(self, suffix: str) -> Path:
+        return self.path.with_name(self.path.name + suffix)
+
+    def _records(self) -> Iterator[Tuple[int, bytes]]:
+        with self._file('.log').open('rb') as f:
+            for number in range(self.count):
+                yield number, f.read(FINGERPRINT_SIZE)
+
+    def _open_index(self) -> None:
+        path = self._file('.idx')
+        try:
+            with path.open('rb') as f:
+                slots, count = self.INDEX_HEADER.unpack(f.read(self.INDEX_HEADER.size))
+        except (OSError, struct.error):
+            slots, count = 0, -1
+        if count != self.count or not self._fits(slots, self.count) or path.stat().st_size != self._index_size(slots):
+            self._rebuild_index(max(self.MIN_SLOTS, 1 << (2 * self.count).bit_length()))
+        else:
+            self._map_index(slots)
+
+    def _open_bloom(self) -> None:
+        self.bloom, count = BloomFilter.load(self._file('.bloom'))
+        if self.bloom is None or count != self.count or self.count > self.capacity:
+            self.capacity = max(self.capacity, 2 * self.count)
+            self.bloom = BloomFilter.for_capacity(self.capacity, self.error_rate)
+            for _, fp in self._records():
+                self.bloom.add(fp)
+
+    @staticmethod
+    def _fits(slots: int, count: int) -> bool:
+        return slots >= 2 * (count + 1)
+
+    def _index_size(self, slots: int) -> int:
+        return self.INDEX_HEADER.size + slots * self.SLOT.size
+
+    def _map_index(self, slots: int) -> None:
+        self.slots = slots
+        self.index_file = self._file('.idx').open('r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+
+    def _close_index(self) -> None:
+        if self.index is not None:
+            self.INDEX_HEADER.pack_into(self.index, 0, self.slots, self.count)
+            self.index.flush()
+            self.index.close()
+            self.index_file.close()
+            self.index = None
+
+    def _rebuild_index(self, slots: int) -> None:
+        self._close_index()
+        temp = self._file('.idx.tmp')
+        with temp.open('wb') as f:
+            f.truncate(self._index_size(slots))
+        os.replace(temp, self._file('.idx'))
+        self._map_index(slots)
+        for number, fp in self._records():
+            slot, found = self._find(fp)
+            if not found:
+                self._set_slot(slot, fp, number)
+
+    # a slot holds 32 bits of the fingerprint and its log record number + 1, 0 is empty
+    def _set_slot(self, slot: int, fp: bytes, number: int) -> None:
+        tag = int.from_bytes(fp[16:20], 'little')
+        self.SLOT.pack_into(self.index, self.INDEX_HEADER.size + slot * self.SLOT.size, tag << 32 | number + 1)
+
+    def _find(self, fp: bytes) -> Tuple[int, bool]:
+        mask = self.slots - 1
+        slot = int.from_bytes(fp[:8], 'little') & mask
+        tag = int.from_bytes(fp[16:20], 'little')
+        while True:
+            value, = self.SLOT.unpack_from(self.index, self.INDEX_HEADER.size + slot * self.SLOT.size)
+            if not value:
+                return slot, False
+            if value >> 32 == tag:
+                offset = ((value & 0xFFFFFFFF) - 1) * FINGERPRINT_SIZE
+                if os.pread(self.log.fileno(), FINGERPRINT_SIZE, offset) == fp:
+                    return slot, True
+            slot = (slot + 1) & mask
+
+    def __contains__(self, fp: bytes) -> bool:
+        return fp in self.bloom and self._find(fp)[1]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, fp: bytes) -> bool:
+        """Adds `fp`, returns whether it was new."""
+        if fp in self.bloom:
+            slot, found = self._find(fp)
+            if found:
+                return False
+        else:
+            slot = None
+        self.log.write(fp)
+        self.log.flush()
+        if not self._fits(self.slots, self.count + 1):
+            self.count += 1
+            self._rebuild_index(2 * self.slots)
+        else:
+            if slot is None:
+                slot, _ = self._find(fp)
+            self._set_slot(slot, fp, self.count)
+            self.count += 1
+        self.bloom.add(fp)
+        return True
+
+    def close(self) -> None:
+        if self.log.closed:
+            return
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log.close()
+        self._close_index()
+        self.bloom.save(self._file('.bloom'), self.count)
+
+
+class SeenFingerprints:
+    """
+    Remembers, per spider and across runs, the fingerprints of the requests that were downloaded
+    and of the items that were scraped, in two FingerprintStores under FINGERPRINT_STORE_DIR. The
+    spider gets them as `seen_requests` and `seen_items`, for its callbacks and item pipelines:
+
+        from course_crawler.fingerprints import fingerprint, item_fingerprint
+
+        if fingerprint(request) not in self.seen_requests:
+            ...
+        if item_fingerprint(item) in spider.seen_items:
+            ...
+
+    Both stores include what the current run added so far. FINGERPRINT_STORE_CAPACITY sizes the
+    Bloom filters for FINGERPRINT_STORE_ERROR_RATE false positives, which only cost a disk lookup.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('FINGERPRINT_STORE_ENABLED'):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.directory = settings.get('FINGERPRINT_STORE_DIR', 'fingerprints')
+        self.capacity = settings.getint('FINGERPRINT_STORE_CAPACITY', 1_000_000)
+        self.error_rate = settings.getfloat('FINGERPRINT_STORE_ERROR_RATE', 0.01)
+        self.requests = None
+        self.items = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        return o
+
+    def spider_opened(self, spider):
+        directory = Path(data_path(self.directory, createdir=True)) / spider.name
+        self.requests = FingerprintStore(directory / 'requests', self.capacity, self.error_rate)
+        self.items = FingerprintStore(directory / 'items', self.capacity, self.error_rate)
+        spider.seen_requests = self.requests
+        spider.seen_items = self.items
+
+    def spider_closed(self, spider):
+        for store in (self.requests, self.items):
+            if store is not None:
+                store.close()
+
+    def response_received(self, response, request, spider):
+        if self.requests.add(fingerprint(request)):
+            self.stats.inc_value('fingerprints/new_requests', spider=spider)
+
+    def item_scraped(self, item, response, spider):
+        if self.items.add(item_fingerprint(item)):
+            self.stats.inc_value('fingerprints/new_items', spider=spider)
@@ -0,0 +1,77 @@
+# Funnelback search.json listings shared by the spiders whose course search runs on Funnelback
+#
+# See documentation in:
+# https://docs.squiz.net/funnelback/docs/latest/build/results-pages/search-results-json.html
+from typing import Dict, List
+
+from scrapy import Request, Spider
+from scrapy.http import TextResponse
+from w3lib.url import add_or_replace_parameter
+
+from course_crawler.subrequests import fetch_all
+
+
+class IncompleteListing(Exception):
+    """Raised when result pages of a Funnelback search could not be downloaded."""
+
+
+def _result_packet(response: TextResponse) -> dict:
+    return response.json()['response']['resultPacket']
+
+
+async def results(spider: Spider, response: TextResponse) -> List[Dict]:
+    """
+    Returns every result record of a Funnelback search, given the response for its first page.
+
+    `totalMatching` of the first page tells how many `start_rank` pages remain, those are fetched
+    concurrently with the first page's `num_ranks`. Records (with their `liveUrl`, `title` and
+    `metaData`) keep the search order and are deduplicated on `liveUrl`.
+
+    Pages that fail are fetched again up to FUNNELBACK_PAGE_RETRIES times, after the downloader's
+    own retries. If one is still missing, IncompleteListing is raised instead of returning part
+    of the listing.
+    """
+    packet = _result_packet(response)
+    summary = packet['resultsSummary']
+    records = list(packet['results'])
+    page_size = summary.get('numRanks') or len(records)
+    total = summary.get('totalMatching') or 0
+
+    stats = spider.crawler.stats
+    if page_size:
+        starts = range(1 + page_size, total + 1, page_size)
+        pages: Dict[int, List[Dict]] = {}
+        for attempt in range(1 + spider.settings.getint('FUNNELBACK_PAGE_RETRIES', 2)):
+            missing = [start for start in starts if start not in pages]
+            if not missing:
+                break
+            if attempt:
+                stats.inc_value('funnelback/retried_pages', len(missing), spider=spider)
+            requests = [
+                Request(add_or_replace_parameter(response.url, 'start_rank', str(start)), dont_filter=True)
+                for start in missing
+            ]
+            for start, page in zip(missing, await fetch_all(spider, requests)):
+                if page is not None:
+                    pages[start] = _result_packet(page)['results']
+
+        missing = [start for start in starts if start not in pages]
+        if missing:
+            stats.inc_value('funnelback/failed_pages', len(missing), spider=spider)
+            raise IncompleteListing(
+                f"{len(missing)} of {len(starts) + 1} result pages of {response.url} could not be "
+                f"downloaded (start_rank {', '.join(map(str, missing))})"
+            )
+        for start in starts:
+            records.extend(pages[start])
+
+    unique, seen = [], set()
+    for record in records:
+        if record.get('liveUrl') and record['liveUrl'] not in seen:
+            seen.add(record['liveUrl'])
+            unique.append(record)
+
+    stats.inc_value('funnelback/records', len(unique), spider=spider)
+    if len(unique) < total:
+        spider.logger.warning('Funnelback listed %i of %i matching results', len(unique), total)
+    return unique
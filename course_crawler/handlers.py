@@ -0,0 +1,496 @@
+# Define here the download handlers for your scraped pages
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/settings.html#download-handlers
+# https://github.com/scrapy-plugins/scrapy-playwright
+import asyncio
+import logging
+import re
+from collections import defaultdict, deque
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from playwright.async_api import (
+    Browser, BrowserType, Error as PlaywrightError, Page, PlaywrightContextManager,
+    Request as PlaywrightRequest,
+)
+from scrapy import Spider
+from scrapy.http import Request, Response
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy_playwright.handler import ScrapyPlaywrightDownloadHandler
+from scrapy_playwright._utils import _maybe_await
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.python.failure import Failure
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessBudget:
+    """
+    Limits shared by every crawler running in the process: rendered pages leased at once across
+    all page pools (PLAYWRIGHT_GLOBAL_MAX_PAGES) and downloads in flight across all downloaders
+    (GLOBAL_CONCURRENT_REQUESTS). The first crawler to ask for a budget sets its size, 0 means
+    no limit.
+    """
+
+    _pages: Optional[asyncio.Semaphore] = None
+    _requests: Optional[DeferredSemaphore] = None
+
+    @classmethod
+    def pages(cls, size: int) -> Optional[asyncio.Semaphore]:
+        if cls._pages is None and size > 0:
+            cls._pages = asyncio.Semaphore(size)
+        return cls._pages
+
+    @classmethod
+    def requests(cls, size: int) -> Optional[DeferredSemaphore]:
+        if cls._requests is None and size > 0:
+            cls._requests = DeferredSemaphore(size)
+        return cls._requests
+
+
+class SharedBrowser:
+    """
+    A browser launched once per process and handed to every download handler with the same
+    browser type and launch options, instead of one browser per crawler. It runs on its own
+    Playwright driver so it outlives the handler that launched it, and closes with the last one.
+    """
+
+    _browsers: Dict[tuple, 'SharedBrowser'] = {}
+
+    def __init__(self, key: tuple, launch_options: dict):
+        self.key = key
+        self.launch_options = launch_options
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.manager: Optional[PlaywrightContextManager] = None
+        self.browser: Optional[Browser] = None
+
+    @classmethod
+    def get(cls, browser_type_name: str, launch_options: dict) -> 'SharedBrowser':
+        key = (browser_type_name, repr(sorted(launch_options.items())))
+        if key not in cls._browsers:
+            cls._browsers[key] = cls(key, launch_options)
+        return cls._browsers[key]
+
+    async def acquire(self) -> Browser:
+        async with self.lock:
+            if self.browser is None or not self.browser.is_connected():
+                if self.manager is None:
+                    self.manager = PlaywrightContextManager()
+                    playwright = await self.manager.start()
+                    self.browser_type: BrowserType = getattr(playwright, self.key[0])
+                logger.info('Launching shared browser %s', self.key[0])
+                self.browser = await self.browser_type.launch(**self.launch_options)
+            self.users += 1
+            return self.browser
+
+    async def release(self) -> None:
+        async with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            if self.browser is not None and self.browser.is_connected():
+                logger.info('Closing shared browser %s', self.key[0])
+                await self.browser.close()
+            if self.manager is not None:
+                await self.manager.__aexit__()
+            self.browser = self.manager = None
+            del self._browsers[self.key]
+
+
+class HedgingPolicy:
+    """
+    Decides when a download gets a duplicate: once `min_samples` latencies of its domain are
+    known, after the `percentile` of the last `window` of them (and never before `min_delay`
+    seconds), as long as no more than `budget` of all downloads were duplicated.
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int, min_delay: float, window: int = 200):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self.downloads = 0
+        self.hedges = 0
+
+    @classmethod
+    def from_settings(cls, settings) -> Optional['HedgingPolicy']:
+        if not settings.getbool('HEDGING_ENABLED'):
+            return None
+        return cls(
+            percentile=settings.getfloat('HEDGING_PERCENTILE', 95),
+            budget=settings.getfloat('HEDGING_BUDGET', 0.05),
+            min_samples=settings.getint('HEDGING_MIN_SAMPLES', 20),
+            min_delay=settings.getfloat('HEDGING_MIN_DELAY', 1.0),
+        )
+
+    def observe(self, domain: str, latency: float) -> None:
+        self.latencies[domain].append(latency)
+
+    def delay(self, domain: str) -> Optional[float]:
+        samples = self.latencies.get(domain)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def may_hedge(self) -> bool:
+        return self.hedges < self.budget * self.downloads
+
+
+class _DomainPages:
+
+    def __init__(self, domain: str, size: int):
+        self.domain = domain
+        self.semaphore = asyncio.Semaphore(size)
+        self.idle = deque()
+        self.generation = 0
+        self.uses = 0
+
+    @property
+    def context_name(self) -> str:
+        return f"pool/{self.domain}/{self.generation}"
+
+
+class PagePool:
+    """
+    Hands out warm Playwright pages, at most `max_pages_per_domain` at a time for each domain.
+    Pages are reset to about:blank when released and their browser context is replaced
+    after `context_max_uses` navigations to keep memory from growing over long crawls.
+    Leases also take a slot of the process-wide `budget`, when there is one.
+    """
+
+    def __init__(self, handler: ScrapyPlaywrightDownloadHandler, max_pages_per_domain: int, context_max_uses: int,
+                 budget: Optional[asyncio.Semaphore] = None):
+        self.handler = handler
+        self.stats = handler.stats
+        self.max_pages_per_domain = max_pages_per_domain
+        self.context_max_uses = context_max_uses
+        self.budget = budget
+        self.domains: Dict[str, _DomainPages] = {}
+        self.leases: Dict[Page, Tuple[_DomainPages, str]] = {}
+
+    async def acquire(self, request: Request, spider: Spider) -> Page:
+        domain = urlparse_cached(request).hostname or ''
+        pages = self.domains.get(domain)
+        if pages is None:
+            pages = self.domains[domain] = _DomainPages(domain, self.max_pages_per_domain)
+
+        await pages.semaphore.acquire()
+        if self.budget is not None:
+            if self.budget.locked():
+                self.stats.inc_value('playwright_pool/budget_wait')
+            try:
+                await self.budget.acquire()
+            except BaseException:
+                pages.semaphore.release()
+                raise
+        try:
+            page = None
+            while pages.idle and page is None:
+                candidate = pages.idle.popleft()
+                if not candidate.is_closed():
+                    page = candidate
+                    self.stats.inc_value('playwright_pool/page_reused')
+
+            request.meta['playwright_context'] = pages.context_name
+            if page is None:
+                page = await self.handler._create_page(request=request, spider=spider)
+                self.stats.inc_value('playwright_pool/page_created')
+        except BaseException:
+            self._release_slots(pages)
+            raise
+
+        self.leases[page] = (pages, pages.context_name)
+        return page
+
+    async def release(self, page: Page, reusable: bool = True) -> None:
+        pages, context_name = self.leases.pop(page)
+        try:
+            if context_name == pages.context_name:
+                pages.uses += 1
+            else:
+                reusable = False
+
+            if reusable and not page.is_closed():
+                try:
+                    await page.goto('about:blank')
+                except PlaywrightError:
+                    reusable = False
+
+            if reusable and not page.is_closed():
+                pages.idle.append(page)
+            elif not page.is_closed():
+                await page.close()
+
+            if pages.uses >= self.context_max_uses:
+                await self._recycle(pages)
+            await self._maybe_close_context(pages, context_name)
+        finally:
+            self._release_slots(pages)
+
+    def _release_slots(self, pages: _DomainPages) -> None:
+        pages.semaphore.release()
+        if self.budget is not None:
+            self.budget.release()
+
+    async def _recycle(self, pages: _DomainPages) -> None:
+        retired = pages.context_name
+        pages.generation += 1
+        pages.uses = 0
+        while pages.idle:
+            page = pages.idle.popleft()
+            if not page.is_closed():
+                await page.close()
+        self.stats.inc_value('playwright_pool/context_recycled')
+        logger.debug('Recycled browser context %s', retired)
+        await self._maybe_close_context(pages, retired)
+
+    async def _maybe_close_context(self, pages: _DomainPages, context_name: str) -> None:
+        if context_name == pages.context_name:
+            return
+        if any(name == context_name for _, name in self.leases.values()):
+            return
+        wrapper = self.handler.context_wrappers.get(context_name)
+        if wrapper is not None:
+            await wrapper.context.close()
+
+
+class ResourceBlockingProfile:
+    """
+    Subresources a rendered page does not need for extraction: Playwright requests with one of
+    `resource_types`, a URL matching one of `url_patterns` or a host under one of `domains` are
+    aborted at the route level. The page's own navigation request is never blocked.
+    """
+
+    def __init__(self, resource_types: Iterable[str] = (), url_patterns: Iterable[str] = (),
+                 domains: Iterable[str] = ()):
+        self.resource_types = set(resource_types)
+        self.url_patterns = [re.compile(pattern) for pattern in url_patterns]
+        self.domains = tuple(domain.lower().lstrip('.') for domain in domains)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            resource_types=settings.getlist('PLAYWRIGHT_BLOCKED_RESOURCE_TYPES'),
+            url_patterns=settings.getlist('PLAYWRIGHT_BLOCKED_URL_PATTERNS'),
+            domains=settings.getlist('PLAYWRIGHT_BLOCKED_DOMAINS'),
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.resource_types or self.url_patterns or self.domains)
+
+    def match(self, request: PlaywrightRequest) -> Optional[str]:
+        """Returns the reason the request is blocked, or None if it may go through."""
+        if request.is_navigation_request() and self._is_main_frame(request):
+            return None
+        if request.resource_type in self.resource_types:
+            return 'resource_type'
+        host = (urlparse(request.url).hostname or '').lower()
+        if any(host == domain or host.endswith(f".{domain}") for domain in self.domains):
+            return 'domain'
+        if any(pattern.search(request.url) for pattern in self.url_patterns):
+            return 'url_pattern'
+        return None
+
+    @staticmethod
+    def _is_main_frame(request: PlaywrightRequest) -> bool:
+        try:
+            return request.frame.parent_frame is None
+        except PlaywrightError:
+            # service worker requests have no frame
+            return False
+
+
+class CourseCrawlerDownloadHandler(ScrapyPlaywrightDownloadHandler):
+    """
+    Playwright download handler that serves rendered requests from a `PagePool`
+    (see the PLAYWRIGHT_POOL_* settings).
+
+    Requests that ask for the page (`playwright_include_page`), bring their own page
+    or pin a named context bypass the pool and keep the scrapy-playwright behaviour.
+
+    Subresources matching the spider's `ResourceBlockingProfile` (see the PLAYWRIGHT_BLOCKED_*
+    settings) are aborted before any PLAYWRIGHT_ABORT_REQUEST predicate is consulted.
+
+    With PLAYWRIGHT_SHARED_BROWSER, crawlers of the same process render in one `SharedBrowser`,
+    and every download waits for the process-wide `ProcessBudget` when one is configured.
+
+    With HEDGING_ENABLED, plain HTTP downloads slower than their domain's usual latency are
+    duplicated following the `HedgingPolicy`; the first one to finish is used and the other is
+    cancelled. Rendered requests are never hedged, a second render costs as much as the first.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        settings = crawler.settings
+
+        self.page_pool = None
+        if settings.getbool('PLAYWRIGHT_POOL_ENABLED'):
+            self.page_pool = PagePool(
+                self,
+                max_pages_per_domain=settings.getint('PLAYWRIGHT_POOL_MAX_PAGES_PER_DOMAIN', 4),
+                context_max_uses=settings.getint('PLAYWRIGHT_POOL_CONTEXT_MAX_USES', 100),
+                budget=ProcessBudget.pages(settings.getint('PLAYWRIGHT_GLOBAL_MAX_PAGES')),
+            )
+
+        self.shared_browser = None
+        if settings.getbool('PLAYWRIGHT_SHARED_BROWSER') and not self.browser_cdp_url:
+            self.shared_browser = SharedBrowser.get(self.browser_type_name, self.launch_options)
+        self.request_budget = ProcessBudget.requests(settings.getint('GLOBAL_CONCURRENT_REQUESTS'))
+        self.hedging = HedgingPolicy.from_settings(settings)
+
+        self.blocking_profile = ResourceBlockingProfile.from_settings(settings)
+        self.blocking_dry_run = settings.getbool('PLAYWRIGHT_BLOCKING_DRY_RUN')
+        self.fallback_abort_request = self.abort_request
+        if self.blocking_profile:
+            self.abort_request = self._abort_request
+
+    async def _maybe_launch_browser(self) -> None:
+        if self.shared_browser is None:
+            return await super()._maybe_launch_browser()
+        async with self.browser_launch_lock:
+            if not hasattr(self, 'browser'):
+                self.browser = await self.shared_browser.acquire()
+
+    async def _close(self) -> None:
+        # the shared browser is closed by its last user, not by the handler's own driver
+        browser = self.__dict__.pop('browser', None) if self.shared_browser is not None else None
+        await super()._close()
+        if browser is not None:
+            await self.shared_browser.release()
+
+    def download_request(self, request: Request, spider: Spider) -> Deferred:
+        if self.request_budget is None:
+            return self._download(request, spider)
+        if not self.request_budget.tokens:
+            self.stats.inc_value('global_budget/request_wait')
+        return self.request_budget.run(self._download, request, spider)
+
+    def _download(self, request: Request, spider: Spider) -> Deferred:
+        if self.hedging is None or request.meta.get('playwright'):
+            return super().download_request(request, spider)
+        return self._download_hedged(request, spider)
+
+    def _download_hedged(self, request: Request, spider: Spider) -> Deferred:
+        policy = self.hedging
+        policy.downloads += 1
+        domain = urlparse_cached(request).hostname or ''
+        started = time()
+        attempts: List[Deferred] = []
+        result = Deferred(lambda _: [attempt.cancel() for attempt in attempts])
+        settled = False
+        running = 0
+
+        def settle(outcome, hedge: bool):
+            nonlocal settled, running
+            running -= 1
+            if settled or result.called:
+                # the loser, cancelled or finished too late
+                return None
+            if isinstance(outcome, Failure) and running:
+                # the other attempt can still succeed, only fail once both have failed
+                return None
+            settled = True
+            if timer is not None and timer.active():
+                timer.cancel()
+            for attempt in attempts:
+                attempt.cancel()
+            if isinstance(outcome, Failure):
+                result.errback(outcome)
+                return None
+            latency = time() - started
+            policy.observe(domain, latency)
+            if hedge:
+                request.meta['download_latency'] = latency
+                self.stats.inc_value('hedging/won')
+            result.callback(outcome)
+            return None
+
+        def launch(hedge: bool) -> None:
+            nonlocal running
+            attempt = super(CourseCrawlerDownloadHandler, self).download_request(
+                request.copy() if hedge else request, spider
+            )
+            attempts.append(attempt)
+            running += 1
+            attempt.addBoth(settle, hedge)
+
+        def hedge() -> None:
+            if settled or not policy.may_hedge():
+                return
+            policy.hedges += 1
+            self.stats.inc_value('hedging/fired')
+            launch(hedge=True)
+
+        # imported here, spiders import this module before the crawler installs its reactor
+        from twisted.internet import reactor
+
+        delay = policy.delay(domain)
+        timer = reactor.callLater(delay, hedge) if delay is not None else None
+        launch(hedge=False)
+        return result
+
+    async def _abort_request(self, request: PlaywrightRequest) -> bool:
+        reason = self.blocking_profile.match(request)
+        if reason is not None:
+            self.stats.inc_value('resource_blocking/request_count')
+            self.stats.inc_value(f"resource_blocking/request_count/{reason}")
+            self.stats.inc_value(f"resource_blocking/request_count/resource_type/{request.resource_type}")
+            if not self.blocking_dry_run:
+                return True
+        if self.fallback_abort_request is not None:
+            return await _maybe_await(self.fallback_abort_request(request))
+        return False
+
+    async def _record_blocked_bytes(self, request: PlaywrightRequest) -> None:
+        # only reachable in dry-run mode: aborted requests never transfer anything
+        if self.blocking_profile.match(request) is None:
+            return
+        try:
+            sizes = await request.sizes()
+        except PlaywrightError:
+            return
+        self.stats.inc_value(
+            'resource_blocking/response_bytes',
+            sizes['responseBodySize'] + sizes['responseHeadersSize'],
+        )
+
+    async def _create_page(self, request: Request, spider: Spider) -> Page:
+        page = await super()._create_page(request, spider)
+        if self.blocking_profile and self.blocking_dry_run:
+            page.on('requestfinished', self._record_blocked_bytes)
+        return page
+
+    def _is_poolable(self, request: Request) -> bool:
+        return not (
+            request.meta.get('playwright_include_page')
+            or isinstance(request.meta.get('playwright_page'), Page)
+            or 'playwright_context' in request.meta
+            or 'playwright_context_kwargs' in request.meta
+        )
+
+    async def _download_request(self, request: Request, spider: Spider) -> Response:
+        if self.page_pool is None or not self._is_poolable(request):
+            return await super()._download_request(request, spider)
+
+        page = await self.page_pool.acquire(request, spider)
+        # the handler leaves pages it was given (or asked to include) open,
+        # which lets the pool take them back once the response is built
+        request.meta['playwright_page'] = page
+        request.meta['playwright_include_page'] = True
+        reusable = False
+        try:
+            response = await super()._download_request(request, spider)
+            reusable = True
+            return response
+        finally:
+            request.meta.pop('playwright_page', None)
+            request.meta.pop('playwright_include_page', None)
+            request.meta.pop('playwright_context', None)
+            await self.page_pool.release(page, reusable=reusable)
@@ -0,0 +1,147 @@
+# HTTP cache for daily recrawls: every cached page is revalidated with the origin
+# (If-None-Match / If-Modified-Since) and its body is only downloaded again when it changed
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#module-scrapy.downloadermiddlewares.httpcache
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import IgnoreRequest
+from scrapy.extensions.httpcache import RFC2616Policy
+
+
+CONDITIONAL_HEADERS = (b'If-None-Match', b'If-Modified-Since')
+
+
+def _has_validators(response):
+    return b'ETag' in response.headers or b'Last-Modified' in response.headers
+
+
+class RevalidatingPolicy(RFC2616Policy):
+    """
+    Never trusts a cached response without asking the origin first, and only stores
+    200 responses that carry an ETag or Last-Modified validator to ask with.
+    """
+
+    def should_cache_response(self, response, request):
+        if b'no-store' in self._parse_cachecontrol(response) or response.status != 200:
+            return False
+        return _has_validators(response)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        self._set_conditional_validators(request, cachedresponse)
+        return False
+
+
+class RevalidatingHttpCacheMiddleware(HttpCacheMiddleware):
+    """
+    HttpCacheMiddleware for RevalidatingPolicy that also covers Playwright requests.
+
+    A Playwright request with a cached response is sent as a plain conditional GET first: on a 304
+    the cached (rendered) body is served. A changed page that RenderingStrategyMiddleware takes
+    over plain HTTP is served (and stored) from that probe; otherwise the request is issued again
+    without validators and rendered. Requests that want the page (`playwright_include_page`) or
+    run page methods are never cached. Cached responses without validators count as misses.
+
+    Hit, revalidate and miss ratios are added to the stats when the spider closes.
+    """
+
+    def _is_cacheable(self, request):
+        return not (
+            request.meta.get('dont_cache', False)
+            or request.meta.get('playwright_include_page')
+            or request.meta.get('playwright_page_methods')
+        )
+
+    def process_request(self, request, spider):
+        if request.meta.get('httpcache_probe') and request.meta.get('playwright'):
+            # the probe's body broke the spider's contract (RenderingStrategyMiddleware), render it
+            del request.meta['httpcache_probe']
+            request.meta.pop('cached_response', None)
+            self.stats.inc_value('httpcache/invalidate', spider=spider)
+            self._drop_validators(request.headers)
+            request.meta['httpcache_refresh'] = True
+
+        # refreshed requests were just revalidated, their response only needs storing
+        if not self._is_cacheable(request) or request.meta.get('httpcache_refresh'):
+            return None
+
+        if not self.policy.should_cache_request(request):
+            request.meta['_dont_cache'] = True
+            return None
+
+        cachedresponse = self.storage.retrieve_response(spider, request)
+        if cachedresponse is None or not _has_validators(cachedresponse):
+            self.stats.inc_value('httpcache/miss', spider=spider)
+            if self.ignore_missing:
+                self.stats.inc_value('httpcache/ignore', spider=spider)
+                raise IgnoreRequest(f"Ignored request not in cache: {request}")
+            return None
+
+        cachedresponse.flags.append('cached')
+        if self.policy.is_cached_response_fresh(cachedresponse, request):
+            self.stats.inc_value('httpcache/hit', spider=spider)
+            return cachedresponse
+
+        request.meta['cached_response'] = cachedresponse
+        if request.meta.get('playwright'):
+            # ask the origin whether the page changed before paying for a render
+            request.meta['playwright'] = False
+            request.meta['httpcache_probe'] = True
+        return None
+
+    def process_response(self, request, response, spider):
+        if not self._is_cacheable(request):
+            # neither stored nor counted
+            return response
+        if 'cached' in response.flags:
+            return super().process_response(request, response, spider)
+
+        if request.meta.get('httpcache_refresh'):
+            self._cache_response(spider, response, request, None)
+            return response
+
+        if request.meta.pop('httpcache_probe', False):
+            cachedresponse = request.meta.get('cached_response')
+            if not self.policy.is_cached_response_valid(cachedresponse, response, request):
+                request.meta.pop('cached_response', None)
+                self.stats.inc_value('httpcache/invalidate', spider=spider)
+                if request.meta.get('rendering') == 'http':
+                    # would be downloaded over plain HTTP again
+                    self._cache_response(spider, response, request, None)
+                    return response
+                request.meta['playwright'] = True
+                return self._refresh(request)
+            request.meta['playwright'] = True
+
+        return super().process_response(request, response, spider)
+
+    @staticmethod
+    def _drop_validators(headers):
+        for header in CONDITIONAL_HEADERS:
+            headers.pop(header, None)
+
+    def _refresh(self, request):
+        headers = request.headers.copy()
+        self._drop_validators(headers)
+        return request.replace(
+            headers=headers,
+            meta={**request.meta, 'httpcache_refresh': True},
+            dont_filter=True,
+        )
+
+    def spider_closed(self, spider):
+        super().spider_closed(spider)
+
+        counts = {
+            'hit': self.stats.get_value('httpcache/hit', 0, spider=spider),
+            'revalidate': self.stats.get_value('httpcache/revalidate', 0, spider=spider),
+            'miss': (self.stats.get_value('httpcache/miss', 0, spider=spider)
+                     + self.stats.get_value('httpcache/invalidate', 0, spider=spider)),
+        }
+        total = sum(counts.values())
+        if not total:
+            return
+        for key, count in counts.items():
+            self.stats.set_value(f"httpcache/ratio/{key}", round(count / total, 3), spider=spider)
+        spider.logger.info(
+            'HTTP cache: %(hit)i hits, %(revalidate)i revalidated, %(miss)i misses', counts
+        )
@@ -0,0 +1,267 @@
+# Crash-safe resumable crawls: a journal of the crawl frontier, completed requests and scraped
+# items that a rerun with the same job id picks up from
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/jobs.html
+# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+import os
+import pickle
+from pathlib import Path
+from time import time
+from typing import Iterator
+from weakref import WeakKeyDictionary
+
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint, request_from_dict
+
+
+class Journal:
+    """
+    Append-only file of pickled records. Every record is flushed as it is written and the file is
+    fsynced at most every `fsync_interval` seconds; a record cut short by a crash ends the journal.
+    """
+
+    def __init__(self, path: Path, fsync_interval: float):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.synced = 0.0
+
+    def read(self) -> Iterator[tuple]:
+        try:
+            with self.path.open('rb') as f:
+                while True:
+                    try:
+                        yield pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+                        return
+        except FileNotFoundError:
+            return
+
+    def rewrite(self, records) -> None:
+        """Replaces the journal with `records`, e.g. to drop what a resumed job no longer needs."""
+        self.close()
+        temp = self.path.with_suffix('.tmp')
+        with temp.open('wb') as f:
+            for record in records:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+
+    def write(self, *record) -> None:
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.file is None:
+            self.file = self.path.open('ab')
+        self.file.write(data)
+        self.file.flush()
+        if time() - self.synced >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.synced = time()
+
+    def close(self) -> None:
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def delete(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+def _feed_paths(settings) -> set:
+    uris = set(settings.getdict('FEEDS'))
+    if settings.get('FEED_URI'):
+        uris.add(str(settings['FEED_URI']))
+    paths = set()
+    for uri in uris:
+        if uri.startswith('file://'):
+            uri = uri[len('file://'):]
+        if '://' not in uri and '%(' not in uri:
+            paths.add(os.path.abspath(uri))
+    return paths
+
+
+class ResumableJobMiddleware:
+    """
+    Makes a crawl resumable after it is killed, when it is given a job id:
+
+        scrapy crawl swansea -a job=swansea-2024-05
+        python swansea.py swansea-2024-05
+
+    Scheduled requests, the fingerprints of requests whose response was fully processed, scraped
+    items and the spider's `reference_resources` values are journaled under CRAWL_JOB_DIR as the
+    crawl goes. A rerun with the same job id restores the reference values, schedules the
+    requests that never completed (ahead of the start requests), drops requests that already
+    completed and writes the items scraped so far to the feed again, so the feed of the resumed
+    run holds every item of the job exactly once. Local feed files the interrupted run was
+    writing to are truncated first.
+
+    A request that cannot be journaled (a callback that is not a spider method, live objects in
+    its meta) is logged as an error and counted in jobs/unserializable, and the response that
+    yielded it is not marked completed, so a resumed job crawls that response again.
+
+    The journal is deleted when the job finishes, the next run with that id starts over.
+    """
+
+    def __init__(self, crawler, journal: Journal):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.journal = journal
+        self.pending = {}
+        self.done = set()
+        self.items = []
+        self.state = {}
+        self.feeds = set()
+        self.state_saved = False
+        self.replaying = False
+        # fingerprint of the response each request was yielded by
+        self.parents = WeakKeyDictionary()
+        self.incomplete = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        spider = crawler.spider
+        job = getattr(spider, 'job', None) or settings.get('CRAWL_JOB_ID')
+        if not job:
+            raise NotConfigured
+        directory = Path(data_path(settings.get('CRAWL_JOB_DIR', 'jobs'), createdir=True)) / spider.name
+        directory.mkdir(exist_ok=True)
+        journal = Journal(directory / f"{job}.journal", settings.getfloat('CRAWL_JOB_FSYNC_INTERVAL', 5))
+
+        o = cls(crawler, journal)
+        o._load()
+        o._prepare_feeds(_feed_paths(settings))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        return o
+
+    def _load(self):
+        for record in self.journal.read():
+            kind = record[0]
+            if kind == 'request':
+                self.pending[record[1]] = record[2]
+            elif kind == 'done':
+                self.done.add(record[1])
+            elif kind == 'item':
+                self.items.append((record[1], record[2]))
+            elif kind == 'state':
+                self.state = record[1]
+            elif kind == 'feed':
+                self.feeds.add(record[1])
+        for fp in self.done:
+            self.pending.pop(fp, None)
+        # items of a response that was cut short are scraped again with the response
+        self.items = [(fp, item) for fp, item in self.items if fp in self.done]
+
+    def _prepare_feeds(self, paths):
+        for path in paths & self.feeds:
+            if os.path.exists(path):
+                open(path, 'wb').close()
+        self.feeds |= paths
+        self.journal.rewrite([
+            *(('done', fp) for fp in self.done),
+            *(('request', fp, d) for fp, d in self.pending.items()),
+            *(('item', fp, item) for fp, item in self.items),
+            *([('state', self.state)] if self.state else []),
+            *(('feed', path) for path in self.feeds),
+        ])
+
+    @property
+    def resuming(self) -> bool:
+        return bool(self.done or self.pending)
+
+    def spider_opened(self, spider):
+        if not self.resuming:
+            return
+        spider.logger.info(
+            'Resuming job %s: %i requests completed, %i pending, %i items',
+            self.journal.path.stem, len(self.done), len(self.pending), len(self.items),
+        )
+        self.replaying = True
+        try:
+            for _, item in self.items:
+                self.crawler.signals.send_catch_log(
+                    signals.item_scraped, item=item, response=None, spider=spider
+                )
+        finally:
+            self.replaying = False
+        self.stats.set_value('jobs/replayed_items', len(self.items), spider=spider)
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            self.journal.delete()
+        else:
+            self.journal.close()
+
+    def request_scheduled(self, request, spider):
+        try:
+            self.journal.write('request', request_fingerprint(request), request.to_dict(spider=spider))
+        except (ValueError, TypeError, AttributeError, pickle.PicklingError) as e:
+            # callbacks that are not spider methods and live objects in meta cannot be restored
+            self.stats.inc_value('jobs/unserializable', spider=spider)
+            spider.logger.error('Cannot journal %s, a resumed job crawls its response again: %s', request, e)
+            parent = self.parents.get(request)
+            if parent is not None:
+                self.incomplete.add(parent)
+
+    def item_scraped(self, item, response, spider):
+        if self.replaying or response is None:
+            return
+        self.journal.write('item', request_fingerprint(response.request), item)
+
+    def _completed(self, response, spider):
+        request = response.request
+        fingerprints = {request_fingerprint(request)}
+        # the requests that were redirected here are complete as well
+        for url in response.meta.get('redirect_urls', []):
+            fingerprints.add(request_fingerprint(request.replace(url=url)))
+        if request_fingerprint(request) in self.incomplete:
+            # crawled again on resume, for the requests it yielded that were not journaled
+            fingerprints.clear()
+        for fp in fingerprints - self.done:
+            self.done.add(fp)
+            self.journal.write('done', fp)
+
+        if not self.state_saved:
+            # reference resources are resolved before the first response comes in
+            self.state_saved = True
+            state = {
+                resource.attribute: getattr(spider, resource.attribute)
+                for resource in getattr(spider, 'reference_resources', [])
+                if hasattr(spider, resource.attribute)
+            }
+            if state:
+                self.journal.write('state', state)
+
+    def process_start_requests(self, start_requests, spider):
+        for attribute, value in self.state.items():
+            setattr(spider, attribute, value)
+
+        for d in self.pending.values():
+            self.stats.inc_value('jobs/resumed_requests', spider=spider)
+            yield request_from_dict(d, spider=spider)
+        for request in start_requests:
+            fp = request_fingerprint(request)
+            if fp not in self.done and fp not in self.pending:
+                yield request
+
+    def process_spider_output(self, response, result, spider):
+        parent = request_fingerprint(response.request)
+        for element in result:
+            if isinstance(element, Request):
+                if request_fingerprint(element) in self.done:
+                    self.stats.inc_value('jobs/skipped', spider=spider)
+                    continue
+                self.parents[element] = parent
+            yield element
+        self._completed(response, spider)
+
+    def process_spider_exception(self, response, exception, spider):
+        self._completed(response, spider)
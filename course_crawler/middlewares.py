@@ -3,11 +3,29 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import dbm
+import hashlib
+import json
+import os
+import random
+import re
+from collections import defaultdict, deque
+from time import time
+from urllib.parse import urlparse
+
+from scrapy import Request, signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import TextResponse
+from scrapy.utils.project import data_path
+from scrapy.utils.request import request_fingerprint
+from twisted.internet.defer import Deferred
+from twisted.internet.task import deferLater
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from course_crawler.utils import callback_name
+
 
 class CourseCrawlerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +119,641 @@ class CourseCrawlerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class RenderingStrategyMiddleware:
+    """
+    Fetches Playwright requests over plain HTTP first and only renders them in the browser when
+    the response breaks the spider's contract for the callback, e.g.
+
+        required_selectors = {'parse_course': ['#course-content']}
+
+    The outcome is remembered per URL pattern (host and path without the last segment), so once
+    RENDERING_ESCALATION_THRESHOLD pages of a pattern needed the browser, the rest go straight to it.
+    The conditional GET RevalidatingHttpCacheMiddleware sends for a cached Playwright request gets
+    the same decision, so a changed page is not downloaded again over HTTP.
+    """
+
+    def __init__(self, stats, escalation_threshold):
+        self.stats = stats
+        self.escalation_threshold = escalation_threshold
+        self.failures = defaultdict(int)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats, crawler.settings.getint('RENDERING_ESCALATION_THRESHOLD', 2))
+
+    def _required_selectors(self, request, spider):
+        return getattr(spider, 'required_selectors', {}).get(callback_name(request))
+
+    def _pattern(self, url):
+        parsed = urlparse(url)
+        path = re.sub(r'\d+', '#', parsed.path.rstrip('/'))
+        return f"{parsed.hostname}{path.rsplit('/', 1)[0]}"
+
+    def process_request(self, request, spider):
+        if 'rendering' in request.meta:
+            return None
+        if not (request.meta.get('playwright') or request.meta.get('httpcache_probe')):
+            return None
+        # the callback needs the page itself, or something has to happen on it
+        if request.meta.get('playwright_include_page') or request.meta.get('playwright_page_methods'):
+            return None
+        if not self._required_selectors(request, spider):
+            return None
+
+        if self.failures[self._pattern(request.url)] >= self.escalation_threshold:
+            request.meta['rendering'] = 'browser'
+            self.stats.inc_value('rendering/browser', spider=spider)
+        else:
+            request.meta['rendering'] = 'http'
+            request.meta['playwright'] = False
+            self.stats.inc_value('rendering/http', spider=spider)
+        return None
+
+    def process_response(self, request, response, spider):
+        if request.meta.get('rendering') != 'http' or response.status != 200:
+            return response
+
+        selectors = self._required_selectors(request, spider)
+        pattern = self._pattern(request.url)
+        if isinstance(response, TextResponse) and all(response.css(selector) for selector in selectors):
+            self.failures[pattern] = 0
+            return response
+
+        self.failures[pattern] += 1
+        self.stats.inc_value('rendering/escalated', spider=spider)
+        spider.logger.debug('Rendering %s in the browser, missing one of %s', request.url, selectors)
+        return request.replace(
+            meta={**request.meta, 'playwright': True, 'rendering': 'browser'},
+            dont_filter=True,
+        )
+
+
+class _DomainWindow:
+
+    def __init__(self, window, delay):
+        self.window = window
+        self.delay = delay
+        self.stable_window = window
+        self.latency = {}
+        self.samples = defaultdict(int)
+        self.last_backoff = 0.0
+        # good responses left before a backoff's window and delay may relax again
+        self.hold = 0
+        self.hold_delay = 0.0
+        self.recent = deque(maxlen=200)
+        self.responses = 0
+        self.errors = 0
+
+    def percentile(self, percentile):
+        if not self.recent:
+            return None
+        latencies = sorted(self.recent)
+        return round(latencies[min(len(latencies) - 1, int(percentile / 100 * len(latencies)))], 3)
+
+    def profile(self, now):
+        return {
+            'time': now,
+            'window': round(self.stable_window, 2),
+            'delay': round(self.delay, 3),
+            'latency': {mode: round(average, 3) for mode, average in self.latency.items()},
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'error_rate': round(self.errors / self.responses, 3) if self.responses else 0.0,
+            'responses': self.responses,
+        }
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Per-domain AIMD controller for the downloader slots, used instead of AutoThrottle.
+
+    Each successful response grows the domain's concurrency window by 1/window (about one
+    request per round trip). A 429, a 5xx, a download error or a latency spike (a response slower
+    than ADAPTIVE_CONCURRENCY_LATENCY_SPIKE times the average) multiplies it by
+    ADAPTIVE_CONCURRENCY_BACKOFF, at most once per round trip, and divides the delay by it. The
+    slot delay follows the average latency divided by the window and is jittered per request by
+    RANDOMIZE_DOWNLOAD_DELAY. After a backoff the window does not grow and the delay does not drop
+    below its backed-off value until ADAPTIVE_CONCURRENCY_BACKOFF_HOLD good responses came in.
+    Rendered and plain HTTP latencies are averaged separately.
+
+    When the spider closes, each domain's smoothed window, delay, latency averages and
+    percentiles and error rate are saved to a JSON profile per spider under
+    ADAPTIVE_CONCURRENCY_PROFILE_DIR. The next run starts the domain from that profile instead
+    of ADAPTIVE_CONCURRENCY_START and DOWNLOAD_DELAY. A profile is weighted down towards those
+    defaults by half every ADAPTIVE_CONCURRENCY_PROFILE_HALF_LIFE seconds of age.
+    """
+
+    # domains with fewer responses in a run keep the profile of the run before
+    PROFILE_MIN_RESPONSES = 10
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_window = settings.getfloat('ADAPTIVE_CONCURRENCY_START', 2)
+        self.max_window = settings.getfloat(
+            'ADAPTIVE_CONCURRENCY_MAX', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+        )
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_DELAY', 60)
+        self.latency_spike = settings.getfloat('ADAPTIVE_CONCURRENCY_LATENCY_SPIKE', 2.0)
+        self.backoff = settings.getfloat('ADAPTIVE_CONCURRENCY_BACKOFF', 0.5)
+        self.backoff_hold = settings.getint('ADAPTIVE_CONCURRENCY_BACKOFF_HOLD', 10)
+        self.profile_dir = settings.get('ADAPTIVE_CONCURRENCY_PROFILE_DIR')
+        self.half_life = settings.getfloat('ADAPTIVE_CONCURRENCY_PROFILE_HALF_LIFE', 7 * 24 * 3600)
+        self.windows = {}
+        self.profiles = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        if o.profile_dir:
+            crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def _profile_path(self, spider):
+        return os.path.join(data_path(self.profile_dir, createdir=True), f"{spider.name}.json")
+
+    def spider_opened(self, spider):
+        try:
+            with open(self._profile_path(spider), encoding='utf-8') as f:
+                self.profiles = json.load(f)
+        except (OSError, ValueError):
+            self.profiles = {}
+
+    def spider_closed(self, spider):
+        now = time()
+        for key, domain in self.windows.items():
+            if domain.responses >= self.PROFILE_MIN_RESPONSES:
+                self.profiles[key] = domain.profile(now)
+        path = self._profile_path(spider)
+        # sharded workers of a spider save theirs at the same time
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(self.profiles, f, indent=2, sort_keys=True)
+        os.replace(temp, path)
+
+    def _min_delay(self, spider):
+        return getattr(spider, 'download_delay', self.crawler.settings.getfloat('DOWNLOAD_DELAY'))
+
+    def _new_window(self, key, spider):
+        min_delay = self._min_delay(spider)
+        domain = _DomainWindow(self.start_window, min_delay)
+        profile = self.profiles.get(key)
+        if profile is None:
+            return domain
+
+        weight = 0.5 ** (max(0.0, time() - profile['time']) / self.half_life)
+        window = self.start_window + weight * (profile['window'] - self.start_window)
+        domain.window = min(self.max_window, max(1.0, window))
+        domain.stable_window = domain.window
+        domain.delay = min(self.max_delay, max(min_delay, min_delay + weight * (profile['delay'] - min_delay)))
+        if weight >= 0.5:
+            # recent enough to judge latency spikes against from the first response
+            domain.latency = dict(profile['latency'])
+            domain.samples.update({mode: 5 for mode in domain.latency})
+        self.stats.inc_value('adaptive_concurrency/warm_starts', spider=spider)
+        spider.logger.debug('Warm start for %s: window %.2f, delay %.3f', key, domain.window, domain.delay)
+        return domain
+
+    def _apply(self, key, domain, spider, slot=None):
+        slot = slot or self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = max(1, int(domain.window))
+            slot.delay = domain.delay
+        self.stats.set_value(f"adaptive_concurrency/window/{key}", round(domain.window, 2), spider=spider)
+        self.stats.set_value(f"adaptive_concurrency/delay/{key}", round(domain.delay, 3), spider=spider)
+        self.stats.max_value(f"adaptive_concurrency/max_window/{key}", round(domain.window, 2), spider=spider)
+
+    def process_request(self, request, spider):
+        # the downloader drops idle slots, so the window is applied again on every request
+        key, slot = self.crawler.engine.downloader._get_slot(request, spider)
+        domain = self.windows.get(key)
+        if domain is None:
+            domain = self.windows[key] = self._new_window(key, spider)
+        self._apply(key, domain, spider, slot)
+        return None
+
+    def process_response(self, request, response, spider):
+        key = request.meta.get('download_slot')
+        domain = self.windows.get(key)
+        latency = request.meta.get('download_latency')
+        if domain is None or 'cached' in response.flags or 'coalesced' in response.flags:
+            return response
+
+        mode = 'browser' if request.meta.get('playwright') else 'http'
+        average = domain.latency.get(mode)
+        domain.responses += 1
+        if response.status == 429 or response.status >= 500:
+            domain.errors += 1
+        if response.status == 429:
+            self._back_off(key, domain, '429', spider)
+        elif response.status >= 500:
+            self._back_off(key, domain, '5xx', spider)
+        elif (latency is not None and average is not None and domain.samples[mode] >= 5
+              and latency > self.latency_spike * average):
+            self._back_off(key, domain, 'latency', spider)
+        elif domain.hold:
+            domain.hold -= 1
+        else:
+            domain.window = min(self.max_window, domain.window + 1 / domain.window)
+
+        domain.stable_window = 0.9 * domain.stable_window + 0.1 * domain.window
+        if latency is not None:
+            average = latency if average is None else 0.7 * average + 0.3 * latency
+            domain.latency[mode] = average
+            domain.samples[mode] += 1
+            domain.recent.append(latency)
+            min_delay = max(self._min_delay(spider), domain.hold_delay if domain.hold else 0.0)
+            domain.delay = min(self.max_delay, max(min_delay, average / domain.window))
+        self._apply(key, domain, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        key = request.meta.get('download_slot')
+        domain = self.windows.get(key)
+        # a coalesced request shares the error of a download that was already counted
+        coalesced = request.meta.get('download_coalesced')
+        if domain is not None and not isinstance(exception, IgnoreRequest) and not coalesced:
+            domain.responses += 1
+            domain.errors += 1
+            self._back_off(key, domain, 'exception', spider)
+            self._apply(key, domain, spider)
+        return None
+
+    def _back_off(self, key, domain, reason, spider):
+        now = time()
+        if now - domain.last_backoff < max(domain.latency.values(), default=1.0):
+            return
+        domain.last_backoff = now
+        domain.window = max(1.0, domain.window * self.backoff)
+        domain.delay = min(self.max_delay, domain.delay / self.backoff)
+        domain.hold = self.backoff_hold
+        domain.hold_delay = domain.delay
+        self.stats.inc_value(f"adaptive_concurrency/backoff/{reason}", spider=spider)
+        spider.logger.debug('Backing off %s (%s): window %.2f', key, reason, domain.window)
+
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class _Circuit:
+
+    def __init__(self, window):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.openings = 0
+        self.timer = None
+        self.probe = None
+        self.waiting = []
+
+
+class CircuitBreakerMiddleware:
+    """
+    Per-domain circuit breaker, so a site that is down or rate-limiting is not hammered with
+    retries (each of them possibly a full browser navigation).
+
+    A domain's circuit opens when at least CIRCUIT_BREAKER_FAILURE_RATIO of its last
+    CIRCUIT_BREAKER_WINDOW downloads (and no fewer than CIRCUIT_BREAKER_MIN_REQUESTS) failed with a
+    download error or one of the RETRY_HTTP_CODES. While it is open, the domain's requests wait
+    here for CIRCUIT_BREAKER_BACKOFF seconds, doubled on every consecutive opening up to
+    CIRCUIT_BREAKER_MAX_BACKOFF and jittered like RANDOMIZE_DOWNLOAD_DELAY. Then a single probe
+    request goes through: the circuit closes and lets the waiting requests go if it succeeds,
+    and opens again if it fails. Retried requests are held back the same way, for
+    CIRCUIT_BREAKER_RETRY_BACKOFF seconds doubled on every retry.
+
+    Requests already queued in the domain's downloader slot when the circuit opens are still
+    sent, their outcomes are not counted. Waiting does not block the reactor: other domains, and
+    the other crawlers of the process, keep downloading. Stats: circuit_breaker/opened, circuit_breaker/closed,
+    circuit_breaker/probes, circuit_breaker/paused and circuit_breaker/delayed_retries.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('CIRCUIT_BREAKER_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.window = settings.getint('CIRCUIT_BREAKER_WINDOW', 20)
+        self.min_requests = settings.getint('CIRCUIT_BREAKER_MIN_REQUESTS', 10)
+        self.failure_ratio = settings.getfloat('CIRCUIT_BREAKER_FAILURE_RATIO', 0.5)
+        self.backoff = settings.getfloat('CIRCUIT_BREAKER_BACKOFF', 30)
+        self.max_backoff = settings.getfloat('CIRCUIT_BREAKER_MAX_BACKOFF', 600)
+        self.retry_backoff = settings.getfloat('CIRCUIT_BREAKER_RETRY_BACKOFF', 2)
+        self.failure_codes = {int(code) for code in settings.getlist('RETRY_HTTP_CODES')}
+        self.circuits = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_closed(self, spider):
+        for circuit in self.circuits.values():
+            if circuit.timer is not None and circuit.timer.active():
+                circuit.timer.cancel()
+
+    def _circuit(self, request, spider):
+        key = self.crawler.engine.downloader._get_slot_key(request, spider)
+        circuit = self.circuits.get(key)
+        if circuit is None:
+            circuit = self.circuits[key] = _Circuit(self.window)
+        return key, circuit
+
+    def _backoff(self, base, exponent):
+        return min(self.max_backoff, base * 2 ** exponent) * random.uniform(0.5, 1.5)
+
+    def process_request(self, request, spider):
+        retries = request.meta.get('retry_times', 0)
+        if retries:
+            from twisted.internet import reactor
+            self.stats.inc_value('circuit_breaker/delayed_retries', spider=spider)
+            return deferLater(reactor, self._backoff(self.retry_backoff, retries - 1), self._admit, request, spider)
+        return self._admit(request, spider)
+
+    def _admit(self, request, spider):
+        key, circuit = self._circuit(request, spider)
+        if circuit.state == CLOSED:
+            return None
+        if circuit.state == HALF_OPEN and circuit.probe is None:
+            self._start_probe(circuit, request, spider)
+            return None
+        self.stats.inc_value('circuit_breaker/paused', spider=spider)
+        waiter = Deferred()
+        circuit.waiting.append((request, waiter))
+        return waiter
+
+    def _start_probe(self, circuit, request, spider):
+        circuit.probe = request
+        self.stats.inc_value('circuit_breaker/probes', spider=spider)
+
+    def _half_open(self, circuit, spider):
+        circuit.timer = None
+        circuit.state = HALF_OPEN
+        if circuit.waiting:
+            request, waiter = circuit.waiting.pop(0)
+            self._start_probe(circuit, request, spider)
+            waiter.callback(None)
+
+    def process_response(self, request, response, spider):
+        if 'cached' not in response.flags:
+            self._record(request, response.status in self.failure_codes, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            key, circuit = self._circuit(request, spider)
+            if circuit.probe is request:
+                # dropped on its way, the next request probes instead
+                circuit.probe = None
+                self._half_open(circuit, spider)
+        else:
+            self._record(request, True, spider)
+        return None
+
+    def _record(self, request, failed, spider):
+        key, circuit = self._circuit(request, spider)
+        if circuit.probe is request:
+            circuit.probe = None
+            if failed:
+                self._open(key, circuit, spider)
+            else:
+                self._close(key, circuit, spider)
+            return
+        # a coalesced request shares the outcome of a download that was already counted
+        if circuit.state != CLOSED or request.meta.get('download_coalesced'):
+            return
+
+        circuit.outcomes.append(failed)
+        failures = sum(circuit.outcomes)
+        if (failed and len(circuit.outcomes) >= self.min_requests
+                and failures >= self.failure_ratio * len(circuit.outcomes)):
+            self._open(key, circuit, spider)
+
+    def _open(self, key, circuit, spider):
+        # imported here, spiders import this module before the crawler installs its reactor
+        from twisted.internet import reactor
+        delay = self._backoff(self.backoff, circuit.openings)
+        circuit.openings += 1
+        circuit.state = OPEN
+        circuit.outcomes.clear()
+        circuit.timer = reactor.callLater(delay, self._half_open, circuit, spider)
+        self.stats.inc_value('circuit_breaker/opened', spider=spider)
+        spider.logger.warning('Circuit for %s opened, pausing it for %.0fs', key, delay)
+
+    def _close(self, key, circuit, spider):
+        circuit.state = CLOSED
+        circuit.openings = 0
+        waiting, circuit.waiting = circuit.waiting, []
+        self.stats.inc_value('circuit_breaker/closed', spider=spider)
+        spider.logger.info('Circuit for %s closed, resuming %i requests', key, len(waiting))
+        for _, waiter in waiting:
+            waiter.callback(None)
+
+
+class CoalescingMiddleware:
+    """
+    Shares one download between identical requests in flight at the same time, e.g. a course
+    linked from several listing pages with dont_filter=True. A request with the fingerprint,
+    rendering mode and conditional headers of one that is downloading waits for it and gets a
+    copy of its response (flagged 'coalesced'), or its download error, bound to its own request
+    and meta; the other downloader middlewares still process it on its own. Requests that ask
+    for the Playwright page are never shared.
+
+    Downloads saved this way are counted in the coalescing/saved stat.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.in_flight = {}
+        self.leading = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('COALESCING_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats)
+
+    def _key(self, request):
+        if request.meta.get('playwright_include_page'):
+            return None
+        return (
+            request_fingerprint(request),
+            bool(request.meta.get('playwright')),
+            request.headers.get('If-None-Match'),
+            request.headers.get('If-Modified-Since'),
+        )
+
+    def process_request(self, request, spider):
+        key = self._key(request)
+        if key is None:
+            return None
+        if key not in self.in_flight:
+            request.meta.pop('download_coalesced', None)
+            self.in_flight[key] = []
+            self.leading[request] = key
+            return None
+
+        request.meta['download_coalesced'] = True
+        self.stats.inc_value('coalescing/saved', spider=spider)
+        deferred = Deferred()
+        self.in_flight[key].append((request, deferred))
+        return deferred
+
+    def process_response(self, request, response, spider):
+        for follower, deferred in self._followers(request):
+            deferred.callback(response.replace(request=follower, flags=response.flags + ['coalesced']))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        for _, deferred in self._followers(request):
+            deferred.errback(exception)
+        return None
+
+    def _followers(self, request):
+        key = self.leading.pop(request, None)
+        if key is None:
+            return []
+        return self.in_flight.pop(key)
+
+
+class ContentUnchanged(Exception):
+    """Raised for a response whose content region matches the previous run."""
+
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+
+
+class ContentHashMiddleware:
+    """
+    Skips the callback for course pages whose content did not change since the previous run and
+    emits the items it produced back then instead. The spider names the content region of each
+    callback, so volatile headers and footers do not count as changes, e.g.
+
+        content_selectors = {'parse_course': ['main']}
+
+    The region is hashed together with the request's plain meta values (title, qualification, ...)
+    and stored with the callback's items under the course link (`course_link` meta or URL) in a dbm
+    file per spider under CONTENT_HASH_DIR. Outputs with follow-up requests are never stored, and
+    stored items older than CONTENT_HASH_MAX_AGE seconds are extracted again.
+
+    Scrapy hands the short-circuit of a request with an `errback` to that errback, which only has
+    to clean up (close its Playwright page, ...): the stored items are emitted after its output.
+    """
+
+    IGNORED_META_PREFIXES = (
+        '_', 'download_', 'playwright', 'httpcache_', 'rendering', 'depth', 'retry_', 'redirect_',
+        'handle_httpstatus', 'dont_', 'content_hash', 'cached_response', 'request_kind', 'course_family',
+    )
+
+    def __init__(self, stats, directory, max_age):
+        self.stats = stats
+        self.directory = directory
+        self.max_age = max_age
+        self.db = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('CONTENT_HASH_ENABLED'):
+            raise NotConfigured
+        o = cls(crawler.stats, settings.get('CONTENT_HASH_DIR', 'contenthash'),
+                settings.getint('CONTENT_HASH_MAX_AGE', 7 * 24 * 3600))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        path = data_path(self.directory, createdir=True)
+        self.db = dbm.open(f"{path}/{spider.name}.db", 'c')
+
+    def spider_closed(self, spider):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _content_hash(self, response, selectors):
+        region = [html for selector in selectors for html in response.css(selector).getall()]
+        if not region:
+            return None
+        meta = {
+            key: value for key, value in response.meta.items()
+            if isinstance(value, (str, int, float, bool)) and not key.startswith(self.IGNORED_META_PREFIXES)
+        }
+        digest = hashlib.sha256(json.dumps(meta, sort_keys=True).encode())
+        for html in region:
+            digest.update(html.encode())
+        return digest.hexdigest()
+
+    def _key(self, response):
+        return f"{callback_name(response.request)}:{response.meta.get('course_link', response.url)}"
+
+    def process_spider_input(self, response, spider):
+        request = response.request
+        selectors = getattr(spider, 'content_selectors', {}).get(callback_name(request))
+        if not selectors or not isinstance(response, TextResponse):
+            return None
+
+        content_hash = self._content_hash(response, selectors)
+        if content_hash is None:
+            return None
+        response.meta['content_hash'] = content_hash
+
+        stored = self.db.get(self._key(response))
+        if stored is None:
+            self.stats.inc_value('content_hash/new', spider=spider)
+            return None
+        stored = json.loads(stored)
+        if stored['hash'] != content_hash or time() - stored['time'] > self.max_age:
+            self.stats.inc_value('content_hash/changed', spider=spider)
+            return None
+
+        self.stats.inc_value('content_hash/unchanged', spider=spider)
+        if request.errback is not None:
+            # the errback's output comes back through process_spider_output
+            response.meta['content_unchanged'] = stored['items']
+        raise ContentUnchanged(stored['items'])
+
+    def process_spider_output(self, response, result, spider):
+        unchanged = response.meta.pop('content_unchanged', None)
+        if unchanged is not None:
+            yield from result
+            yield from unchanged
+            return
+
+        content_hash = response.meta.get('content_hash')
+        if content_hash is None:
+            yield from result
+            return
+
+        items = []
+        for element in result:
+            if items is not None:
+                if isinstance(element, Request) or not is_item(element):
+                    items = None
+                else:
+                    try:
+                        # snapshot before the item pipelines get to modify it
+                        items.append(json.dumps(ItemAdapter(element).asdict()))
+                    except TypeError:
+                        items = None
+            yield element
+
+        if items is not None:
+            self.db[self._key(response)] = json.dumps({
+                'hash': content_hash,
+                'time': time(),
+                'items': [json.loads(item) for item in items],
+            })
+            self.stats.inc_value('content_hash/stored', spider=spider)
+
+    def process_spider_exception(self, response, exception, spider):
+        if isinstance(exception, ContentUnchanged):
+            return exception.items
+        return None
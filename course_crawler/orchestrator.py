@@ -0,0 +1,48 @@
+# Runs several university spiders in a single process: the crawlers share one browser and the
+# process-wide page and request budgets (see course_crawler/handlers.py), while each of them
+# keeps its own per-domain concurrency and delays
+#
+#     python -m course_crawler.orchestrator                    # every spider
+#     python -m course_crawler.orchestrator harper strath      # a chosen set
+#     python -m course_crawler.orchestrator --job nightly      # resumable (see course_crawler/jobs.py)
+import argparse
+from typing import Dict, Iterable, Optional
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+
+# spider templates that are not meant to run
+EXCLUDED_SPIDERS = {'example'}
+
+
+def run(spiders: Iterable[str] = (), job: Optional[str] = None) -> Dict[str, dict]:
+    """Crawls `spiders` (all of them by default) concurrently and returns their stats by name."""
+    process = CrawlerProcess(get_project_settings())
+    names = list(spiders) or [
+        name for name in process.spider_loader.list() if name not in EXCLUDED_SPIDERS
+    ]
+
+    crawlers = {}
+    for name in names:
+        crawlers[name] = process.create_crawler(name)
+        process.crawl(crawlers[name], job=job)
+    process.start()
+    return {name: crawler.stats.get_stats() for name, crawler in crawlers.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawl several universities in one process.')
+    parser.add_argument('spiders', nargs='*', help='spider names, every spider when omitted')
+    parser.add_argument('--job', help='job id that makes the crawls resumable')
+    args = parser.parse_args()
+
+    for name, stats in run(args.spiders, args.job).items():
+        print(
+            f"{name}: {stats.get('finish_reason')}, {stats.get('item_scraped_count', 0)} items "
+            f"in {stats.get('elapsed_time_seconds', 0):.0f}s"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Reusable Playwright page methods for rendered listing pages
+#
+# See documentation in:
+# https://github.com/scrapy-plugins/scrapy-playwright#executing-actions-on-pages
+from scrapy_playwright.page import PageMethod
+
+
+SCROLL_UNTIL_STABLE_SCRIPT = """
+async ({itemSelector, loadMoreSelector, quietMs, pollMs, maxRounds, maxMs}) => {
+    const started = Date.now()
+    const count = () => document.querySelectorAll(itemSelector).length
+
+    let items = count()
+    let grownAt = Date.now()
+    let rounds = 0
+    let stopped = 'max_rounds'
+
+    while (rounds < maxRounds) {
+        if (Date.now() - started >= maxMs) {
+            stopped = 'max_time'
+            break
+        }
+        rounds++
+
+        const loadMore = loadMoreSelector ? document.querySelector(loadMoreSelector) : null
+        if (loadMore) {
+            loadMore.click()
+        }
+        window.scrollTo(0, document.body.scrollHeight)
+        await new Promise(resolve => setTimeout(resolve, pollMs))
+
+        const current = count()
+        if (current > items) {
+            items = current
+            grownAt = Date.now()
+        } else if (Date.now() - grownAt >= quietMs) {
+            stopped = 'stable'
+            break
+        }
+    }
+    return {items, rounds, elapsed_ms: Date.now() - started, stopped}
+}
+"""
+
+
+def scroll_until_stable(item_selector: str, load_more_selector: str = None, quiet_ms: int = 1500,
+                        poll_ms: int = 250, max_rounds: int = 200, max_ms: int = 60000) -> PageMethod:
+    """
+    Scrolls to the bottom of the page (clicking `load_more_selector` first if it is present) until
+    the number of `item_selector` matches has not grown for `quiet_ms`, or `max_rounds`/`max_ms` is hit.
+
+    After the request is downloaded the page method's `result` holds a dict with the final
+    `items` count, the number of `rounds`, `elapsed_ms` and why it `stopped`
+    ('stable', 'max_rounds' or 'max_time').
+    """
+    return PageMethod('evaluate', SCROLL_UNTIL_STABLE_SCRIPT, {
+        'itemSelector': item_selector,
+        'loadMoreSelector': load_more_selector,
+        'quietMs': quiet_ms,
+        'pollMs': poll_ms,
+        'maxRounds': max_rounds,
+        'maxMs': max_ms,
+    })
+
+
+def record_scroll_result(spider, page_method: PageMethod) -> None:
+    """Stores the outcome of a `scroll_until_stable` page method in the crawl stats."""
+    result = page_method.result
+    if not result:
+        return
+    stats = spider.crawler.stats
+    stats.inc_value('scroll_until_stable/count', spider=spider)
+    stats.inc_value('scroll_until_stable/rounds', result['rounds'], spider=spider)
+    stats.inc_value('scroll_until_stable/elapsed_ms', result['elapsed_ms'], spider=spider)
+    stats.inc_value('scroll_until_stable/items', result['items'], spider=spider)
+    stats.inc_value(f"scroll_until_stable/stopped/{result['stopped']}", spider=spider)
+    spider.logger.info(
+        'Scrolled %s: %i items after %i rounds in %i ms (%s)',
+        spider.name, result['items'], result['rounds'], result['elapsed_ms'], result['stopped']
+    )
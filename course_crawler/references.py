@@ -0,0 +1,122 @@
+# Reference pages (language requirements, default application dates, ...) that course
+# callbacks read from the spider instance
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+import pickle
+from pathlib import Path
+from time import time
+from typing import Optional
+
+from scrapy import Request, signals
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.project import data_path
+
+from course_crawler.subrequests import engine_paused, fetch_all
+
+
+class ReferenceResource:
+    """
+    A page whose parsed content the spider needs before building course items. `parse` names
+    the spider method that turns the response into the value stored on the spider as `attribute`.
+    """
+
+    def __init__(self, attribute: str, url: str, parse: str, ttl: Optional[int] = None):
+        self.attribute = attribute
+        self.url = url
+        self.parse = parse
+        self.ttl = ttl
+
+    def __repr__(self):
+        return f"ReferenceResource({self.attribute!r}, {self.url!r})"
+
+
+class ReferenceResources:
+    """
+    Resolves a spider's `reference_resources` before any of its start requests are pulled, so
+    course callbacks never run without them:
+
+        reference_resources = [
+            ReferenceResource('english_language_certificate_map', url, 'parse_english_requirements'),
+        ]
+
+    With REFERENCE_CACHE_ENABLED, parsed values are pickled per spider under REFERENCE_CACHE_DIR
+    and reused by later runs until they are older than the resource's `ttl` (REFERENCE_CACHE_TTL
+    seconds by default). A resource that cannot be fetched falls back to its stale value, if there
+    is one. Without it, every resource is fetched on each run.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.cache_enabled = settings.getbool('REFERENCE_CACHE_ENABLED')
+        self.directory = settings.get('REFERENCE_CACHE_DIR', 'references')
+        self.ttl = settings.getint('REFERENCE_CACHE_TTL', 7 * 24 * 3600)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = cls(crawler)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        return o
+
+    def spider_opened(self, spider):
+        if not getattr(spider, 'reference_resources', None):
+            return None
+        return deferred_from_coro(self._resolve(spider))
+
+    def _path(self, spider) -> Path:
+        return Path(data_path(self.directory, createdir=True)) / f"{spider.name}.pickle"
+
+    def _load(self, spider) -> dict:
+        if not self.cache_enabled:
+            return {}
+        try:
+            with self._path(spider).open('rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return {}
+
+    def _save(self, spider, cache: dict) -> None:
+        if not self.cache_enabled:
+            return
+        with self._path(spider).open('wb') as f:
+            pickle.dump(cache, f)
+
+    async def _resolve(self, spider):
+        cache = self._load(spider)
+        now = time()
+        stale = []
+        for resource in spider.reference_resources:
+            cached = cache.get(resource.attribute)
+            ttl = self.ttl if resource.ttl is None else resource.ttl
+            if cached is not None and cached['url'] == resource.url and now - cached['time'] < ttl:
+                setattr(spider, resource.attribute, cached['value'])
+                self.stats.inc_value('references/cached', spider=spider)
+            else:
+                stale.append(resource)
+        if not stale:
+            return
+
+        # course callbacks depend on these, keep everything else back until they resolve
+        async with engine_paused(self.crawler):
+            requests = [Request(resource.url, dont_filter=True) for resource in stale]
+            responses = await fetch_all(spider, requests)
+            for resource, response in zip(stale, responses):
+                try:
+                    if response is None:
+                        raise ValueError(f"could not download {resource.url}")
+                    value = getattr(spider, resource.parse)(response)
+                except Exception:
+                    self.stats.inc_value('references/failed', spider=spider)
+                    cached = cache.get(resource.attribute)
+                    if cached is not None:
+                        spider.logger.warning('Using the stale %s from %s', resource, cached['url'])
+                        setattr(spider, resource.attribute, cached['value'])
+                    else:
+                        spider.logger.error('Could not resolve %s', resource, exc_info=True)
+                    continue
+                setattr(spider, resource.attribute, value)
+                cache[resource.attribute] = {'url': resource.url, 'time': now, 'value': value}
+                self.stats.inc_value('references/fetched', spider=spider)
+        self._save(spider, cache)
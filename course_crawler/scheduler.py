@@ -0,0 +1,208 @@
+# Depth-first scheduling over course "families": a course detail request and the requests
+# its response leads to are finished before the listings start new courses
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/scheduler.html
+import itertools
+from collections import Counter, defaultdict, deque
+from typing import Optional, Set
+
+from scrapy import Request
+from scrapy.core.scheduler import Scheduler
+
+from course_crawler.utils import callback_name
+
+
+LISTING, DETAIL, SUB = 'listing', 'detail', 'sub'
+
+
+def is_course_request(request: Request, spider, callbacks) -> bool:
+    """Whether `request` is for a course detail page: its callback is one of the spider's
+    `course_callbacks`, or one of `callbacks` when the spider does not list its own."""
+    return callback_name(request) in getattr(spider, 'course_callbacks', callbacks)
+
+
+class CourseFamilyMiddleware:
+    """
+    Tags every request with the kind of page it fetches (`request_kind` meta) for CourseScheduler:
+
+    * 'detail': the callback builds course items, the request starts a new family
+    * 'sub': the request was yielded by the response of a family, it joins that family
+    * 'listing': anything else (start requests, listing and pagination pages)
+
+    Course callbacks are COURSE_FAMILY_CALLBACKS unless the spider lists its own:
+
+        course_callbacks = ['_parse_course_details_with_soup']
+    """
+
+    def __init__(self, crawler, callbacks):
+        self.crawler = crawler
+        self.callbacks = callbacks
+        self.families = itertools.count(1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler, crawler.settings.getlist('COURSE_FAMILY_CALLBACKS', ['parse_course']))
+
+    def _tag(self, request, family, spider):
+        if is_course_request(request, spider, self.callbacks):
+            request.meta['request_kind'] = DETAIL
+            request.meta['course_family'] = next(self.families)
+        elif family is not None:
+            request.meta['request_kind'] = SUB
+            request.meta['course_family'] = family
+        else:
+            request.meta['request_kind'] = LISTING
+            request.meta.pop('course_family', None)
+        return request
+
+    def process_start_requests(self, start_requests, spider):
+        for request in start_requests:
+            yield self._tag(request, None, spider)
+
+    def process_spider_output(self, response, result, spider):
+        family = response.meta.get('course_family')
+        for element in result:
+            if isinstance(element, Request):
+                self._tag(element, family, spider)
+            yield element
+
+
+class CourseScheduler(Scheduler):
+    """
+    Scheduler that favours finishing the courses in progress over starting new ones.
+
+    Requests are raised by SCHEDULER_KIND_PRIORITY for their `request_kind`, so sub-requests of
+    a course go before course details and course details before listing pages. A family is open
+    while any of its requests is queued, in progress in the engine (downloading, waiting on a
+    coalesced download, ...) or has its response or failure with the scraper; requests that are
+    ignored, answered without a download or fail leave the family as they leave the engine. Once
+    SCHEDULER_MAX_OPEN_FAMILIES are open, new course detail requests are parked in memory and
+    only queued as other families close; a parked request is also let through whenever the queue
+    is empty and nothing is downloading or being parsed, so the cap never stalls a crawl.
+
+    Queue depth per kind is kept in the scheduler/depth/<kind> and scheduler/max_depth/<kind>
+    stats, parked requests count as scheduler/depth/parked.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.kind_priority = {}
+        self.max_open_families = 0
+        # queued requests of the open families, and their requests taken off the queue
+        self.open_families = Counter()
+        self.running = defaultdict(list)
+        self.parked = deque()
+        self.depth = Counter()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        o = super().from_crawler(crawler)
+        o.kind_priority = crawler.settings.getdict('SCHEDULER_KIND_PRIORITY')
+        o.max_open_families = crawler.settings.getint('SCHEDULER_MAX_OPEN_FAMILIES')
+        return o
+
+    def close(self, reason):
+        # parked requests are part of the crawl state a JOBDIR run resumes from
+        if self.dqs is not None:
+            while self.parked:
+                self._dqpush(self.parked.popleft())
+        return super().close(reason)
+
+    def __len__(self) -> int:
+        return super().__len__() + len(self.parked)
+
+    def enqueue_request(self, request: Request) -> bool:
+        if not request.dont_filter and self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return False
+
+        kind = request.meta.get('request_kind', LISTING)
+        if 'request_kind_priority' not in request.meta:
+            # retried and redirected copies keep the raised priority
+            request.meta['request_kind_priority'] = self.kind_priority.get(kind, 0)
+            request.priority += request.meta['request_kind_priority']
+
+        family = request.meta.get('course_family')
+        if kind == DETAIL and family not in self.open_families and self._is_full():
+            self.parked.append(request)
+            self.stats.inc_value('scheduler/parked', spider=self.spider)
+        else:
+            self._push(request)
+        self._update_depth()
+        return True
+
+    def next_request(self) -> Optional[Request]:
+        self._close_finished_families()
+        request = super().next_request()
+        if request is None and self.parked and self._is_idle():
+            # whatever was keeping the families open will not close them any more
+            self._push(self.parked.popleft())
+            request = super().next_request()
+        if request is not None:
+            kind = request.meta.get('request_kind', LISTING)
+            self.depth[kind] = max(self.depth[kind] - 1, 0)
+            family = request.meta.get('course_family')
+            if family is not None:
+                self.open_families[family] -= 1
+                self.running[family].append(request)
+            self._update_depth()
+        return request
+
+    def _is_idle(self) -> bool:
+        engine = self.crawler.engine
+        return not engine.downloader.active and engine.scraper.slot.is_idle()
+
+    def _is_full(self) -> bool:
+        return bool(self.max_open_families) and len(self.open_families) >= self.max_open_families
+
+    def _push(self, request: Request) -> None:
+        if self._dqpush(request):
+            self.stats.inc_value('scheduler/enqueued/disk', spider=self.spider)
+        else:
+            self._mqpush(request)
+            self.stats.inc_value('scheduler/enqueued/memory', spider=self.spider)
+        self.stats.inc_value('scheduler/enqueued', spider=self.spider)
+        self.depth[request.meta.get('request_kind', LISTING)] += 1
+        family = request.meta.get('course_family')
+        if family is not None:
+            self.open_families[family] += 1
+
+    def _busy_requests(self) -> Set[Request]:
+        # a request goes from the engine's slot to the scraper's queue in one call chain
+        engine = self.crawler.engine
+        scraper = engine.scraper.slot
+        busy = set(scraper.active)
+        busy.update(request for _, request, _ in scraper.queue)
+        if engine.slot is not None:
+            busy.update(engine.slot.inprogress)
+        return busy
+
+    def _close_finished_families(self) -> None:
+        if not self.open_families:
+            return
+        busy = self._busy_requests()
+        finished = []
+        for family, queued in self.open_families.items():
+            running = [request for request in self.running.get(family, ()) if request in busy]
+            if queued <= 0 and not running:
+                finished.append(family)
+            else:
+                self.running[family] = running
+        if not finished:
+            return
+        for family in finished:
+            del self.open_families[family]
+            self.running.pop(family, None)
+        self.stats.inc_value('scheduler/families_finished', len(finished), spider=self.spider)
+        while self.parked and not self._is_full():
+            self._push(self.parked.popleft())
+        self._update_depth()
+
+    def _update_depth(self) -> None:
+        values = {**self.depth, 'parked': len(self.parked)}
+        for kind, depth in values.items():
+            self.stats.set_value(f"scheduler/depth/{kind}", depth, spider=self.spider)
+            self.stats.max_value(f"scheduler/max_depth/{kind}", depth, spider=self.spider)
+        self.stats.set_value('scheduler/open_families', len(self.open_families), spider=self.spider)
+        self.stats.max_value('scheduler/max_open_families', len(self.open_families), spider=self.spider)
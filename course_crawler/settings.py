@@ -7,9 +7,6 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-import random
-
-
 BOT_NAME = 'course_crawler'
 
 SPIDER_MODULES = ['course_crawler.spiders']
@@ -28,7 +25,8 @@ FEED_FORMAT = 'json'
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 8
+# Per-domain concurrency is left to AdaptiveConcurrencyMiddleware, this is only the global ceiling
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -52,21 +50,47 @@ TELNETCONSOLE_ENABLED = False
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'course_crawler.middlewares.CourseCrawlerSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'course_crawler.jobs.ResumableJobMiddleware': 800,
+    'course_crawler.scheduler.CourseFamilyMiddleware': 850,
+    'course_crawler.shards.ShardMiddleware': 900,
+    'course_crawler.sitemaps.SitemapDiscoveryMiddleware': 925,
+    'course_crawler.middlewares.ContentHashMiddleware': 950,
+    'course_crawler.documents.ParseParityMiddleware': 975,
+}
+
+# Course detail requests and whatever their responses lead to go before new listing pages, and
+# no more than SCHEDULER_MAX_OPEN_FAMILIES courses are queued or downloading at once, so items
+# come out steadily during the run (see course_crawler/scheduler.py). Spiders whose detail
+# callback is not one of COURSE_FAMILY_CALLBACKS list it in `course_callbacks`
+SCHEDULER = 'course_crawler.scheduler.CourseScheduler'
+SCHEDULER_KIND_PRIORITY = {'listing': 0, 'detail': 10, 'sub': 20}
+SCHEDULER_MAX_OPEN_FAMILIES = 64
+COURSE_FAMILY_CALLBACKS = ['parse_course']
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'course_crawler.middlewares.CourseCrawlerDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'course_crawler.httpcache.RevalidatingHttpCacheMiddleware': 540,
+    'course_crawler.middlewares.RenderingStrategyMiddleware': 545,
+    'course_crawler.middlewares.AdaptiveConcurrencyMiddleware': 950,
+    'course_crawler.middlewares.CircuitBreakerMiddleware': 970,
+    'course_crawler.middlewares.CoalescingMiddleware': 990,
+}
+
+# Identical requests in flight at the same time (listings linking a course several times with
+# dont_filter=True) share one download. Closest to the downloader, so every request still goes
+# through the other middlewares on its own
+COALESCING_ENABLED = True
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'course_crawler.references.ReferenceResources': 500,
+    'course_crawler.fingerprints.SeenFingerprints': 550,
+    'course_crawler.extraction.ExtractionPool': 600,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -76,11 +100,12 @@ TELNETCONSOLE_ENABLED = False
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# Replaced by AdaptiveConcurrencyMiddleware, both of them adjust the downloader slots
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
-AUTOTHROTTLE_START_DELAY = 5
+#AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
-AUTOTHROTTLE_MAX_DELAY = 60
+#AUTOTHROTTLE_MAX_DELAY = 60
 # The average number of requests Scrapy should be sending in parallel to
 # each remote server
 #AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
@@ -89,24 +114,179 @@ AUTOTHROTTLE_MAX_DELAY = 60
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = 'httpcache'
+# Cached pages are revalidated on every run and only downloaded (and rendered) again when
+# the origin reports a change (see course_crawler/httpcache.py). The middleware sits in front
+# of RenderingStrategyMiddleware so it sees Playwright requests before they are downgraded
+HTTPCACHE_ENABLED = True
+HTTPCACHE_POLICY = 'course_crawler.httpcache.RevalidatingPolicy'
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = 'httpcache'
 # HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 
+# Opt-in hedging of plain HTTP downloads (see course_crawler/handlers.py): once a domain has
+# HEDGING_MIN_SAMPLES latencies, a download slower than their HEDGING_PERCENTILE is duplicated
+# and the first response wins. No more than HEDGING_BUDGET of the downloads are duplicated
+HEDGING_ENABLED = False
+HEDGING_PERCENTILE = 95
+HEDGING_BUDGET = 0.05
+HEDGING_MIN_SAMPLES = 20
+HEDGING_MIN_DELAY = 1.0
+
 RETRY_ENABLED = True
 RETRY_TIMES = 3  
+
+# Per-domain circuit breaker (see course_crawler/middlewares.py): a domain is paused once
+# CIRCUIT_BREAKER_FAILURE_RATIO of its last CIRCUIT_BREAKER_WINDOW downloads failed, for
+# CIRCUIT_BREAKER_BACKOFF seconds doubling up to CIRCUIT_BREAKER_MAX_BACKOFF, and resumed when a
+# single probe request succeeds. Retries wait CIRCUIT_BREAKER_RETRY_BACKOFF seconds, doubling
+# per retry. Behind RetryMiddleware so retried requests go through it as well
+CIRCUIT_BREAKER_ENABLED = True
+CIRCUIT_BREAKER_WINDOW = 20
+CIRCUIT_BREAKER_MIN_REQUESTS = 10
+CIRCUIT_BREAKER_FAILURE_RATIO = 0.5
+CIRCUIT_BREAKER_BACKOFF = 30
+CIRCUIT_BREAKER_MAX_BACKOFF = 600
+CIRCUIT_BREAKER_RETRY_BACKOFF = 2
 DOWNLOAD_TIMEOUT = 90
-DOWNLOAD_DELAY = 2*random.uniform(0.1, 1)
+# Lower bound of the per-domain delay, RANDOMIZE_DOWNLOAD_DELAY spreads
+# every single wait between 0.5 and 1.5 times the current delay
+DOWNLOAD_DELAY = 0.5
+RANDOMIZE_DOWNLOAD_DELAY = True
+
+# Per-domain AIMD concurrency (see course_crawler/middlewares.py), a domain starts with
+# ADAPTIVE_CONCURRENCY_START parallel requests and DOWNLOAD_DELAY, and its current window
+# and delay are kept in the adaptive_concurrency/* stats
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_START = 2
+ADAPTIVE_CONCURRENCY_MAX = 8
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 60
+# A response slower than this many times the domain's average latency counts as congestion
+ADAPTIVE_CONCURRENCY_LATENCY_SPIKE = 2.0
+# Factor applied to the window on a 429, a 5xx, a download error or a latency spike
+ADAPTIVE_CONCURRENCY_BACKOFF = 0.5
+# Good responses a domain must answer with after a backoff before its window grows and its
+# delay drops again
+ADAPTIVE_CONCURRENCY_BACKOFF_HOLD = 10
+# Each domain starts from the window and delay it settled at in the previous runs, saved per
+# spider under ADAPTIVE_CONCURRENCY_PROFILE_DIR (None to always start cold). Profiles count
+# half as much every ADAPTIVE_CONCURRENCY_PROFILE_HALF_LIFE seconds
+ADAPTIVE_CONCURRENCY_PROFILE_DIR = 'throttle'
+ADAPTIVE_CONCURRENCY_PROFILE_HALF_LIFE = 7 * 24 * 3600
 
 DOWNLOAD_HANDLERS = {
-    "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
-    "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
+    "http": "course_crawler.handlers.CourseCrawlerDownloadHandler",
+    "https": "course_crawler.handlers.CourseCrawlerDownloadHandler",
 }
 
+# Reuse warm Playwright pages for rendered requests instead of opening and
+# closing a page per course (see course_crawler/handlers.py)
+PLAYWRIGHT_POOL_ENABLED = True
+# Maximum number of pages kept open for a single domain
+PLAYWRIGHT_POOL_MAX_PAGES_PER_DOMAIN = 4
+# Navigations after which a domain's browser context is closed and replaced
+PLAYWRIGHT_POOL_CONTEXT_MAX_USES = 100
+
+# Crawlers running in one process (python -m course_crawler.orchestrator) render in a single
+# shared browser and share these budgets: pages leased at once across all page pools and
+# downloads in flight across all crawlers (0 for no limit). Per-domain concurrency and delays
+# stay per crawler
+PLAYWRIGHT_SHARED_BROWSER = True
+PLAYWRIGHT_GLOBAL_MAX_PAGES = 12
+GLOBAL_CONCURRENT_REQUESTS = 64
+
+# Subresources aborted on rendered pages; the extractors only read the DOM.
+# Spiders can override any of these lists in their custom_settings
+PLAYWRIGHT_BLOCKED_RESOURCE_TYPES = ["image", "media", "font"]
+PLAYWRIGHT_BLOCKED_URL_PATTERNS = [
+    r"\.(?:png|jpe?g|gif|webp|svg|ico|mp4|webm|woff2?|ttf|otf)(?:\?|$)",
+]
+PLAYWRIGHT_BLOCKED_DOMAINS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "hotjar.com",
+    "clarity.ms",
+    "youtube.com",
+    "ytimg.com",
+    "vimeo.com",
+    "twitter.com",
+    "linkedin.com",
+]
+# Let blocked requests through and count their size in the
+# resource_blocking/response_bytes stat instead of aborting them
+# PLAYWRIGHT_BLOCKING_DRY_RUN = True
+
+# Reference pages a spider declares in `reference_resources` are always fetched before its
+# start requests. With the cache enabled, their parsed values are reused for this long (in
+# seconds) by later runs (see course_crawler/references.py)
+REFERENCE_CACHE_ENABLED = True
+REFERENCE_CACHE_DIR = 'references'
+REFERENCE_CACHE_TTL = 7 * 24 * 3600
+
+# Result pages of a Funnelback listing (see course_crawler/funnelback.py) that still fail after
+# the downloader's retries are requested again this many times, the listing callback fails
+# with IncompleteListing if one is still missing
+FUNNELBACK_PAGE_RETRIES = 2
+
+# Incremental runs: spiders with `sitemap_urls` and a `sitemap_course_pattern` only request
+# course pages that are new or have a sitemap lastmod after their last crawl
+# (see course_crawler/sitemaps.py). Force a full run with `-a full_crawl=true`
+SITEMAP_DISCOVERY_ENABLED = False
+SITEMAP_DISCOVERY_DIR = 'sitemaps'
+
+# Crawls given a job id (`-a job=<id>`, or the first argument of a spider module's __main__)
+# journal their frontier, completed requests and items under CRAWL_JOB_DIR, a killed crawl is
+# resumed by running it again with the same id (see course_crawler/jobs.py)
+CRAWL_JOB_DIR = 'jobs'
+CRAWL_JOB_FSYNC_INTERVAL = 5
+
+# Fingerprints of the requests downloaded and items scraped by every run, per spider under
+# FINGERPRINT_STORE_DIR, queried as `spider.seen_requests` and `spider.seen_items`
+# (see course_crawler/fingerprints.py). The Bloom filters in front of the stores are sized
+# for FINGERPRINT_STORE_CAPACITY fingerprints and grow when a store outgrows it
+FINGERPRINT_STORE_ENABLED = True
+FINGERPRINT_STORE_DIR = 'fingerprints'
+FINGERPRINT_STORE_CAPACITY = 1_000_000
+FINGERPRINT_STORE_ERROR_RATE = 0.01
+
+# Request files and feeds of sharded runs (python -m course_crawler.shards <spider> --workers N),
+# the merged feed is written to the spider's FEED_URI (see course_crawler/shards.py)
+SHARD_DIR = 'shards'
+
+# Callbacks listed in a spider's `content_selectors` are skipped when that region of the page
+# is unchanged since the last run, the items stored then are emitted instead
+CONTENT_HASH_ENABLED = True
+CONTENT_HASH_DIR = 'contenthash'
+# Stored items older than this (in seconds) are extracted again even if the page is unchanged
+CONTENT_HASH_MAX_AGE = 7 * 24 * 3600
+
+# BeautifulSoup tree builder of the documents spiders parse with make_soup
+# (see course_crawler/documents.py). 'lxml' is several times faster than 'html.parser'; a spider
+# switches in its custom_settings, after a run with PARSE_ENGINE_PARITY = True has compared the
+# items of both engines on its pages. The parity run also checks a spider's `parse_regions`, the
+# page regions its documents are cut down to, against a full parse. Only callbacks that hand
+# their extractor to `extract`, and plain (non async) callbacks, are compared: coroutine
+# callbacks that do not (Harper's, which download sub-requests) are counted in
+# parse_parity/skipped and logged once
+PARSE_ENGINE = 'html.parser'
+PARSE_ENGINE_PARITY = False
+
+# Course extractors called through `extract` (see course_crawler/extraction.py) run in a pool
+# of EXTRACTION_POOL_WORKERS processes (0 for one per core) instead of on the reactor thread,
+# with at most EXTRACTION_POOL_MAX_PENDING pages of a crawl queued (0 for twice the workers)
+EXTRACTION_POOL_ENABLED = False
+EXTRACTION_POOL_WORKERS = 0
+EXTRACTION_POOL_MAX_PENDING = 0
+
+# Playwright requests are fetched over plain HTTP first when the spider declares
+# `required_selectors` for their callback; a URL pattern goes straight to the
+# browser once this many of its pages failed the contract
+RENDERING_ESCALATION_THRESHOLD = 2
+
 PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = (
     90 * 1000
 )
@@ -0,0 +1,218 @@
+# Sharded crawls of one university across CPU cores: the listing pages are crawled once, the
+# course detail requests they lead to are split by URL hash between worker processes (each
+# with its own reactor and browser) and the workers' feeds are merged into the spider's feed
+#
+#     python -m course_crawler.shards swansea --workers 8
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List
+
+from scrapy import Request, signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import JsonItemExporter
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import data_path, get_project_settings
+from scrapy.utils.request import request_from_dict
+from w3lib.url import canonicalize_url
+
+from course_crawler.scheduler import is_course_request
+from course_crawler.sitemaps import merge_crawl_times
+
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(url: str, shards: int) -> int:
+    """Returns the shard of a course URL, the same one on every run with the same shard count."""
+    digest = hashlib.sha1(canonicalize_url(url).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+def _shard_dir(settings, spider_name: str) -> Path:
+    return Path(data_path(os.path.join(settings.get('SHARD_DIR', 'shards'), spider_name), createdir=True))
+
+
+class ShardMiddleware:
+    """
+    Splits a crawl between the processes of a sharded run (see `run`), following SHARD_PHASE:
+
+    * 'listing': course detail requests (see `is_course_request`) are not scheduled but written
+      to SHARD_COUNT request files under SHARD_DIR when the spider closes
+    * 'worker': the spider's start requests are replaced by the requests of shard SHARD_INDEX
+
+    It sits below SitemapDiscoveryMiddleware, which filters the listing's course requests before
+    they are split. A course request that cannot be pickled (live objects in its meta) is logged
+    and crawled by the listing process itself.
+    """
+
+    def __init__(self, settings, stats, phase: str, count: int, index: int):
+        self.settings = settings
+        self.stats = stats
+        self.phase = phase
+        self.count = count
+        self.index = index
+        self.callbacks = settings.getlist('COURSE_FAMILY_CALLBACKS', ['parse_course'])
+        self.shards: List[List[dict]] = [[] for _ in range(count)]
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        phase = settings.get('SHARD_PHASE')
+        if not phase:
+            raise NotConfigured
+        o = cls(settings, crawler.stats, phase, settings.getint('SHARD_COUNT', 1), settings.getint('SHARD_INDEX'))
+        if phase == 'listing':
+            crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def _path(self, spider, index: int) -> Path:
+        return _shard_dir(self.settings, spider.name) / f"requests-{index}-of-{self.count}.pickle"
+
+    def process_start_requests(self, start_requests, spider):
+        if self.phase != 'worker':
+            yield from start_requests
+            return
+        with self._path(spider, self.index).open('rb') as f:
+            for d in pickle.load(f):
+                yield request_from_dict(d, spider=spider)
+
+    def process_spider_output(self, response, result, spider):
+        for element in result:
+            if (self.phase == 'listing' and isinstance(element, Request)
+                    and is_course_request(element, spider, self.callbacks)):
+                d = element.to_dict(spider=spider)
+                try:
+                    pickle.dumps(d, protocol=pickle.HIGHEST_PROTOCOL)
+                except (TypeError, AttributeError, pickle.PicklingError) as e:
+                    spider.logger.error('Cannot shard %s, crawling it in the listing process: %s', element, e)
+                    self.stats.inc_value('shards/unserializable', spider=spider)
+                    yield element
+                    continue
+                self.shards[shard_of(element.url, self.count)].append(d)
+                continue
+            yield element
+
+    def spider_closed(self, spider):
+        for index, requests in enumerate(self.shards):
+            # written in full or not at all, a worker never loads a cut-short shard
+            path = self._path(spider, index)
+            temp = path.with_suffix('.tmp')
+            temp.write_bytes(pickle.dumps(requests, protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(temp, path)
+        spider.logger.info(
+            'Split %i course requests into %i shards', sum(map(len, self.shards)), self.count
+        )
+
+
+def _crawl(spider_name: str, overrides: Dict) -> None:
+    settings = get_project_settings()
+    for name, value in overrides.items():
+        # above the spider's custom_settings, which set its feed
+        settings.set(name, value, priority='cmdline')
+    process = CrawlerProcess(settings)
+    process.crawl(spider_name)
+    process.start()
+
+
+def _run_processes(spider_name: str, overrides: List[Dict]) -> None:
+    # every process needs a reactor of its own, forked ones would inherit the parent's
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_crawl, args=(spider_name, o)) for o in overrides]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.error('Crawl process %s of %s exited with %i', process.name, spider_name, process.exitcode)
+
+
+def merge(feeds: List[Path], output: Path, encoding: str = 'utf-8') -> int:
+    """Writes the items of the JSON `feeds` to `output`, ordered by course link, and returns their number."""
+    items = []
+    for feed in feeds:
+        try:
+            items.extend(json.loads(feed.read_text(encoding)))
+        except (OSError, ValueError):
+            logger.error('Shard feed %s is missing or incomplete', feed)
+    items.sort(key=lambda item: (item.get('link') or '', json.dumps(item, sort_keys=True)))
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('wb') as f:
+        exporter = JsonItemExporter(f, encoding=encoding)
+        exporter.start_exporting()
+        for item in items:
+            exporter.export_item(item)
+        exporter.finish_exporting()
+    return len(items)
+
+
+def run(spider_name: str, workers: int) -> Path:
+    """
+    Crawls `spider_name` with `workers` processes and returns the path of the merged feed, the
+    spider's FEED_URI. Per-domain concurrency is divided between the workers, and each of them
+    keeps its content hashes, sitemap crawl times and fingerprint stores apart, under a
+    shard-{i}-of-{n} directory; the sitemap crawl times are merged back once they are done.
+    """
+    settings = get_project_settings()
+    spidercls = SpiderLoader.from_settings(settings).load(spider_name)
+    directory = _shard_dir(settings, spider_name)
+
+    # items of course requests the listing could not shard
+    listing_feed = directory / 'items-listing.json'
+    _run_processes(spider_name, [{
+        'SHARD_PHASE': 'listing',
+        'SHARD_COUNT': workers,
+        'FEED_URI': str(listing_feed),
+        'FEED_FORMAT': 'json',
+        'FEED_STORE_EMPTY': True,
+    }])
+
+    max_concurrency = max(1, settings.getint('ADAPTIVE_CONCURRENCY_MAX') // workers)
+    feeds = [directory / f"items-{index}-of-{workers}.json" for index in range(workers)]
+    _run_processes(spider_name, [
+        {
+            'SHARD_PHASE': 'worker',
+            'SHARD_COUNT': workers,
+            'SHARD_INDEX': index,
+            'FEED_URI': str(feeds[index]),
+            'FEED_FORMAT': 'json',
+            'FEED_STORE_EMPTY': True,
+            'CONTENT_HASH_DIR': os.path.join(settings.get('CONTENT_HASH_DIR'), f"shard-{index}-of-{workers}"),
+            'SITEMAP_DISCOVERY_DIR': os.path.join(settings.get('SITEMAP_DISCOVERY_DIR'), f"shard-{index}-of-{workers}"),
+            'FINGERPRINT_STORE_DIR': os.path.join(settings.get('FINGERPRINT_STORE_DIR'), f"shard-{index}-of-{workers}"),
+            'ADAPTIVE_CONCURRENCY_MAX': max_concurrency,
+            'ADAPTIVE_CONCURRENCY_START': min(settings.getint('ADAPTIVE_CONCURRENCY_START'), max_concurrency),
+        }
+        for index in range(workers)
+    ])
+
+    # the next listing is filtered with the crawl times the workers recorded
+    sitemaps = data_path(settings.get('SITEMAP_DISCOVERY_DIR'), createdir=True)
+    merge_crawl_times(
+        [os.path.join(sitemaps, f"shard-{index}-of-{workers}", f"{spider_name}.db") for index in range(workers)],
+        os.path.join(sitemaps, f"{spider_name}.db"),
+    )
+
+    output = Path(str((spidercls.custom_settings or {}).get('FEED_URI') or directory / f"{spider_name}.json"))
+    count = merge([listing_feed, *feeds], output, settings.get('FEED_EXPORT_ENCODING') or 'utf-8')
+    logger.info('Merged %i items of %i shards into %s', count, workers, output)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawl one university with several processes.')
+    parser.add_argument('spider', help='spider name')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    args = parser.parse_args()
+    print(run(args.spider, args.workers))
+
+
+if __name__ == '__main__':
+    main()
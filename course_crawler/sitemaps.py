@@ -0,0 +1,187 @@
+# Incremental course discovery from the universities' XML sitemaps
+#
+# See documentation in:
+# https://www.sitemaps.org/protocol.html
+# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+import dbm
+import re
+from datetime import datetime, timezone
+from io import BytesIO
+from time import time
+from typing import Iterator, Optional, Tuple
+
+import lxml.etree
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.gz import gunzip
+from scrapy.utils.project import data_path
+from w3lib.url import canonicalize_url
+
+from course_crawler.subrequests import engine_paused, fetch_all
+
+
+def iter_sitemap(body: bytes) -> Iterator[Tuple[str, str, Optional[str]]]:
+    """
+    Streams the entries of a sitemap or sitemap index as (kind, loc, lastmod) tuples, where kind is
+    'sitemap' for the children of an index and 'url' for pages. Parsed entries are freed as it goes,
+    so large sitemaps never sit in memory as a whole tree.
+    """
+    if body[:3] == b'\x1f\x8b\x08':
+        body = gunzip(body)
+    entries = lxml.etree.iterparse(
+        BytesIO(body), events=('end',), recover=True, remove_comments=True, resolve_entities=False
+    )
+    for _, element in entries:
+        kind = element.tag.rsplit('}', 1)[-1]
+        if kind not in ('url', 'sitemap'):
+            continue
+        loc = lastmod = None
+        for child in element:
+            name = child.tag.rsplit('}', 1)[-1] if isinstance(child.tag, str) else ''
+            if name == 'loc' and child.text:
+                loc = child.text.strip()
+            elif name == 'lastmod' and child.text:
+                lastmod = child.text.strip()
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if loc:
+            yield kind, loc, lastmod
+
+
+def parse_lastmod(value: Optional[str]) -> Optional[float]:
+    """Returns a W3C datetime (2024-01-31, 2024-01-31T10:00:00+00:00, ...) as a timestamp."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _url_key(url: str) -> str:
+    return canonicalize_url(url).split('://', 1)[-1].rstrip('/')
+
+
+class SitemapDiscoveryMiddleware:
+    """
+    Only lets course detail requests through when the page is new or changed since it was last
+    crawled, according to the `lastmod` dates of the spider's sitemaps:
+
+        sitemap_urls = ['https://www.example.ac.uk/sitemap.xml']
+        sitemap_course_pattern = r'/postgraduate/[^/]+/?$'
+
+    The sitemaps (and sitemap indexes) are read before the spider's start requests are pulled.
+    Listing pages are still crawled for the detail requests' meta, but detail requests whose URL
+    matches the pattern, is listed with a `lastmod` and was crawled after it are dropped. Crawl
+    times are kept in a dbm file per spider under SITEMAP_DISCOVERY_DIR.
+
+    The output of an incremental run only holds new and changed courses. Run the spider with
+    `-a full_crawl=true` (or without SITEMAP_DISCOVERY_ENABLED) to crawl everything.
+    """
+
+    def __init__(self, crawler, directory):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.directory = directory
+        self.pattern = None
+        self.lastmod = {}
+        self.db = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SITEMAP_DISCOVERY_ENABLED'):
+            raise NotConfigured
+        o = cls(crawler, crawler.settings.get('SITEMAP_DISCOVERY_DIR', 'sitemaps'))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_opened(self, spider):
+        if not getattr(spider, 'sitemap_urls', None) or not getattr(spider, 'sitemap_course_pattern', None):
+            return None
+        if str(getattr(spider, 'full_crawl', '')).lower() in ('1', 'true', 'yes'):
+            spider.logger.info('Full crawl requested, sitemap discovery is off')
+            return None
+
+        self.pattern = re.compile(spider.sitemap_course_pattern)
+        path = data_path(self.directory, createdir=True)
+        self.db = dbm.open(f"{path}/{spider.name}.db", 'c')
+        return deferred_from_coro(self._read_sitemaps(spider))
+
+    def spider_closed(self, spider):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    async def _read_sitemaps(self, spider):
+        # keep the start requests back until the dates are known
+        async with engine_paused(self.crawler):
+            pending, seen = list(spider.sitemap_urls), set()
+            while pending:
+                seen.update(pending)
+                responses = await fetch_all(spider, [Request(url, dont_filter=True) for url in pending])
+                pending = []
+                for response in filter(None, responses):
+                    self.stats.inc_value('sitemap_discovery/sitemaps', spider=spider)
+                    for kind, loc, lastmod in iter_sitemap(response.body):
+                        if kind == 'sitemap' and loc not in seen:
+                            pending.append(loc)
+                        elif kind == 'url' and self.pattern.search(loc):
+                            self.lastmod[_url_key(loc)] = parse_lastmod(lastmod)
+        self.stats.set_value('sitemap_discovery/courses', len(self.lastmod), spider=spider)
+        spider.logger.info('Read %i course URLs from sitemaps', len(self.lastmod))
+
+    def _should_crawl(self, request, spider):
+        if self.db is None or not self.pattern.search(request.url):
+            return True
+        key = _url_key(request.url)
+        lastmod = self.lastmod.get(key)
+        crawled = self.db.get(key)
+        if lastmod is None or crawled is None or float(crawled) < lastmod:
+            self.stats.inc_value('sitemap_discovery/scheduled', spider=spider)
+            return True
+        self.stats.inc_value('sitemap_discovery/skipped', spider=spider)
+        return False
+
+    def process_start_requests(self, start_requests, spider):
+        for request in start_requests:
+            if self._should_crawl(request, spider):
+                yield request
+
+    def process_spider_output(self, response, result, spider):
+        for element in result:
+            if isinstance(element, Request) and not self._should_crawl(element, spider):
+                continue
+            yield element
+
+        if self.db is not None and response.status == 200:
+            for url in {response.url, *response.meta.get('redirect_urls', [])}:
+                if self.pattern.search(url):
+                    self.db[_url_key(url)] = str(time())
+
+
+def merge_crawl_times(sources, target: str) -> int:
+    """
+    Copies the course crawl times of the dbm files `sources` into `target` (all paths without
+    the dbm suffix), keeping the latest time of a URL, and returns the number of URLs copied.
+    Sharded runs record crawl times per worker, merged back so that the next listing is filtered.
+    """
+    copied = 0
+    with dbm.open(target, 'c') as db:
+        for source in sources:
+            try:
+                other = dbm.open(source, 'r')
+            except dbm.error:
+                continue
+            with other:
+                for key in other.keys():
+                    crawled = other[key]
+                    if key not in db or float(db[key]) < float(crawled):
+                        db[key] = crawled
+                        copied += 1
+    return copied
@@ -2,6 +2,7 @@ from datetime import datetime
 import json
 import os
 import re
+import sys
 from pathlib import Path
 from typing import Dict, List
 from urllib.parse import parse_qs
@@ -12,7 +13,10 @@ from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 from scrapy.http import HtmlResponse
 from scrapy_playwright.page import PageMethod
-import requests
+
+from course_crawler.documents import Document, SectionIndex, make_soup, memoized
+from course_crawler.references import ReferenceResource
+from course_crawler.subrequests import fetch_all
 
 
 class HarperSpider(scrapy.Spider):
@@ -44,8 +48,25 @@ class HarperSpider(scrapy.Spider):
     id_pattern = r"\d{6}"
     default_application_dates=[]
     default_language_requirements=[]
+    # resolved before the first course page is requested (course_crawler/references.py)
+    reference_resources = [
+        ReferenceResource(
+            "default_application_dates",
+            "https://www.harper-adams.ac.uk/apply/how-to-apply/595/direct-applications/",
+            "parse_default_application_dates",
+        ),
+        ReferenceResource(
+            "default_language_requirements",
+            "https://www.harper-adams.ac.uk/university-life/international/339/english-language-requirements/",
+            "parse_default_langauge_requirements",
+        ),
+    ]
 
     qualifications_id = {"PgC": 7, "PgD": 8, "MSc": 9, "MRes": 10, "MProf": 11}
+    # regions hashed to skip unchanged course pages on the next run
+    content_selectors = {
+        "parse_course": ["#overview", "#key-course-info", "#entry-requirements", ".tabmenu"]
+    }
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -62,27 +83,6 @@ class HarperSpider(scrapy.Spider):
         Path(f"{output_path}/{self.name}").mkdir(parents=True, exist_ok=True)
 
     def start_requests(self):
-        apllication_url='https://www.harper-adams.ac.uk/apply/how-to-apply/595/direct-applications/'
-        yield scrapy.Request(
-            apllication_url,
-            callback=self.parse_default_application_dates,
-            meta=dict(
-                # playwright=True,
-                # playwright_include_page=True,
-                # errback=self.errback,
-            ),
-        )
-        languagle_url='https://www.harper-adams.ac.uk/university-life/international/339/english-language-requirements/'
-        yield scrapy.Request(
-            languagle_url,
-            callback=self.parse_default_langauge_requirements,
-            meta=dict(
-                # playwright=True,
-                # playwright_include_page=True,
-                # errback=self.errback,
-            ),
-        )
-
         for url in self.start_urls:
             yield scrapy.Request(
                 url,
@@ -96,17 +96,18 @@ class HarperSpider(scrapy.Spider):
             )
 
     def parse_default_application_dates(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = make_soup(response, self)
         application_dates=[]
         selector=soup.select("main li")
         for i in selector:
             date_pattern=re.compile(r'\d{1,2}\s\w+\s\d{4}')
             date=date_pattern.search(i.text)
             if date:
-                self.default_application_dates.append({"value":date.group(0)})
+                application_dates.append({"value":date.group(0)})
+        return application_dates
 
     def parse_default_langauge_requirements(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = make_soup(response, self)
         languagle_requirements=[]
         selector=soup.select_one("#site-wrapper table")
         row=selector.find_all("tr")
@@ -116,12 +117,13 @@ class HarperSpider(scrapy.Spider):
             if test=="Qualification":
                 continue
             else:
-                self.default_language_requirements.append({"language":"English","test":test,"score":score})
+                languagle_requirements.append({"language":"English","test":test,"score":score})
+        return languagle_requirements
 
     def parse_course_list(self, response: HtmlResponse):
         # page = response.meta["playwright_page"]
         # await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = make_soup(response, self)
         courses = soup.select("article")
         for course in courses:
             link = "https://www.harper-adams.ac.uk" + course.select_one("a").get("href")
@@ -145,10 +147,10 @@ class HarperSpider(scrapy.Spider):
                         ),
                     )
 
-    def parse_course(self, response: HtmlResponse):
+    async def parse_course(self, response: HtmlResponse):
         # page = response.meta["playwright_page"]
         # await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = Document(response, self)
         description = self._get_description(soup)
         university_title = self.university
         locations = self._get_locations(soup)
@@ -167,32 +169,29 @@ class HarperSpider(scrapy.Spider):
         tabmenu = soup.select(".tabmenu")
         if tabmenu:
             id = response.meta["course_link"].split("/")[-3].strip()
-            for qualification in qualifications:
-                route = self.qualifications_id.get(qualification)
-                if route:               
-                    yield scrapy.Request(
-                        f"https://www.harper-adams.ac.uk/shared/get-pg-route-modules.cfm?id={id}&year_of_entry=2024&route={route}",
-                        callback=self._parse_modules,
-                        meta=dict(
-                            # playwright=True,
-                            # playwright_include_page=True,
-                            # errback=self.errback,
-                            title=response.meta["title"],
-                            link=response.meta["course_link"],
-                            qualification=qualification,
-                            university_title=university_title,
-                            locations=locations,
-                            description=description,
-                            about=about,
-                            application_dates=application_dates,
-                            start_dates=start_dates,
-                            entry_requirements=entry_requirements,
-                            tuitions=self._get_tuitions(soup,qualification),
-                            language_requirements=language_requirements,
-                        ),
-                    )
-
-                    
+            routes = {
+                qualification: self.qualifications_id[qualification]
+                for qualification in qualifications
+                if qualification in self.qualifications_id
+            }
+            modules = await self._get_modules(id, routes)
+            for qualification in routes:
+                yield {
+                    "title": response.meta["title"],
+                    "link": response.meta["course_link"],
+                    "study_level": self.study_level,
+                    "qualification": qualification,
+                    "university_title": university_title,
+                    "locations": locations,
+                    "description": description,
+                    "about": about,
+                    "application_dates": application_dates,
+                    "start_dates": start_dates,
+                    "entry_requirements": entry_requirements,
+                    "modules": modules[qualification],
+                    "tuitions": self._get_tuitions(soup, qualification),
+                    "language_requirements": language_requirements,
+                }
         else:
             yield {
                 "title": response.meta["title"],
@@ -264,6 +263,7 @@ class HarperSpider(scrapy.Spider):
             locations = []
         return locations
 
+    @memoized
     def _get_start_dates(self, soup: BeautifulSoup):
         try:
             start_dates = []
@@ -291,106 +291,44 @@ class HarperSpider(scrapy.Spider):
             application_dates=self.default_application_dates
         return application_dates
 
-    def _parse_modules(self, response: HtmlResponse):
-        # page = response.meta["playwright_page"]
-        # await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
-        modules = []
-        subjects = soup.select("li a")
-        for subject in subjects:
-            title = subject.text.strip()
-            link = f"https://www.harper-adams.ac.uk/shared/get-module.cfm?id={subject.get('title')}"
-            if subject.findPrevious("strong").text.lower().find("optional") != -1:
-                type = "Optional"
-            elif subject.findPrevious("strong").text.lower().find("compulsory") != -1:
-                type = "Compulsory"
-            else:
-                type = "Compulsory"
-            modules.append({"title": title, "link": link, "type": type})
-
-        yield {
-            "title": response.meta["title"],
-            "link": response.meta["link"],
-            "study_level": self.study_level,
-            "qualification": response.meta["qualification"],
-            "university_title": response.meta["university_title"],
-            "locations": response.meta["locations"],
-            "description": response.meta["description"],
-            "about": response.meta["about"],
-            "application_dates": response.meta["application_dates"],
-            "start_dates": response.meta["start_dates"],
-            "entry_requirements": response.meta["entry_requirements"],
-            "modules": modules,
-            "tuitions":response.meta["tuitions"],
-            "language_requirements": response.meta["language_requirements"],
-        }
-
-    def _parse_modules2(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
-        modules = response.meta['modules']
-        subjects = soup.select("li a")
-        for subject in subjects:
-            title = subject.text.strip()
-            link = f"https://www.harper-adams.ac.uk/shared/get-module.cfm?id={subject.get('title')}"
-            if subject.findPrevious("strong").text.lower().find("optional") != -1:
-                type = "Optional"
-            elif subject.findPrevious("strong").text.lower().find("compulsory") != -1:
-                type = "Compulsory"
+    async def _get_modules(self, id: str, routes: Dict[str, int]) -> Dict[str, List[dict]]:
+        requests = [
+            scrapy.Request(
+                f"https://www.harper-adams.ac.uk/shared/get-pg-route-modules.cfm?id={id}&year_of_entry=2024&route={route}"
+            )
+            for route in routes.values()
+        ]
+        responses = await fetch_all(self, requests)
+        modules = {}
+        for qualification, response in zip(routes, responses):
+            if response is None:
+                modules[qualification] = []
             else:
-                type = "Compulsory"
-            modules.append({"title": title, "link": link, "type": type})
-        # return modules
-
+                soup = make_soup(response, self)
+                modules[qualification] = self._get_route_modules(soup)
+        return modules
 
-    def _get_modules(self, soup: BeautifulSoup, pageurl: str):
+    def _get_route_modules(self, soup: BeautifulSoup):
         try:
             modules = []
-            id_str = pageurl.split("/")[-3].strip()
-            # id = re.search(r'\d+', id_str).group(0)
-            # self.logger.info(f"ID: {id_str}")
-            for route in range(1, 20):
-                url = f"https://www.harper-adams.ac.uk/shared/get-pg-route-modules.cfm?id={id_str}&year_of_entry=2024&route={route}"
-                try:
-                    response = requests.get(url, timeout=1)
-                    # self.logger.info(f"ID: {id_str} Route: {route} URL: {url}")
-                    if response.status_code == 200:
-                        soup = BeautifulSoup(
-                            response.content, "html.parser", from_encoding="utf-8"
-                        )
-                        qualification = soup.find("h3").get_text().split(" ")[0]
-                        self.logger.info(f"{qualification}: {route}")
-                        subjects = soup.select("li a")
-                        for subject in subjects:
-                            title = subject.text.strip()
-                            link = (
-                                "https://www.harper-adams.ac.uk/shared/get-module.cfm?id="
-                                + subject.get("title")
-                            )
-                            if (
-                                subject.findPrevious("strong")
-                                .text.lower()
-                                .find("optional")
-                                != -1
-                            ):
-                                type = "Optional"
-                            elif (
-                                subject.findPrevious("strong")
-                                .text.lower()
-                                .find("compulsory")
-                                != -1
-                            ):
-                                type = "Compulsory"
-                            else:
-                                type = "Compulsory"
-                            modules.append({"title": title, "link": link, "type": type})
-                    route += 1
-                except:
-                    pass
-
+            subjects = soup.select("li a")
+            sections = SectionIndex(soup, type="strong")
+            for subject in subjects:
+                title = subject.text.strip()
+                link = f"https://www.harper-adams.ac.uk/shared/get-module.cfm?id={subject.get('title')}"
+                heading = sections.nearest(subject, "type").text.lower()
+                if heading.find("optional") != -1:
+                    type = "Optional"
+                elif heading.find("compulsory") != -1:
+                    type = "Compulsory"
+                else:
+                    type = "Compulsory"
+                modules.append({"title": title, "link": link, "type": type})
         except AttributeError:
             return []
         return modules
 
+    @memoized
     def _get_tuitions(self, soup: BeautifulSoup, criteria: str):
         tuitions = []
         try:
@@ -611,5 +549,5 @@ class HarperSpider(scrapy.Spider):
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(HarperSpider)
+    cp.crawl(HarperSpider, job=sys.argv[1] if len(sys.argv) > 1 else None)
     cp.start()
\ No newline at end of file
@@ -20,6 +20,9 @@ from scrapy.http import HtmlResponse
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+from course_crawler.documents import make_soup
+from course_crawler import funnelback
+
 
 # TODO: change spider name to match university
 class ArtsSpider(scrapy.Spider):
@@ -50,19 +53,16 @@ class ArtsSpider(scrapy.Spider):
             yield scrapy.Request(url=url,
                                  callback=self.parse_course_list)
 
-    def parse_course_list(self, response: HtmlResponse):
-        # soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
-         data = response.json()
-         course_list = data['response']['resultPacket']['results']
-         for course in course_list:
-             yield scrapy.Request(url=course['liveUrl'],
-                         callback=self.parse_course,
-                         dont_filter=True,
-                         meta=dict(
-                             link=course['liveUrl'],  
-                             title=course['title'],
-                         )
-                         )
+    async def parse_course_list(self, response: HtmlResponse):
+        course_list = await funnelback.results(self, response)
+        for course in course_list:
+            yield scrapy.Request(url=course['liveUrl'],
+                                 callback=self.parse_course,
+                                 dont_filter=True,
+                                 meta=dict(
+                                     link=course['liveUrl'],
+                                     title=course['title'],
+                                 ))
 
     def _get_title(self, soup: Tag) -> Optional[str]:
         try:
@@ -185,7 +185,7 @@ class ArtsSpider(scrapy.Spider):
         return modules
 
     def parse_course(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = make_soup(response, self)
 
         link = response.url
         title = self._get_title(soup)
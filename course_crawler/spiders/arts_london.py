@@ -18,6 +18,9 @@ from scrapy.http import HtmlResponse
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+from course_crawler.documents import Document
+from course_crawler import funnelback
+
 
 class ArtsLondonSpider(scrapy.Spider):
 
@@ -46,9 +49,8 @@ class ArtsLondonSpider(scrapy.Spider):
         for url in self.start_urls:
             yield scrapy.Request(url=url, callback=self.parse_course_list)
 
-    def parse_course_list(self, response: HtmlResponse):
-        data = response.json()
-        course_list = data["response"]["resultPacket"]["results"]
+    async def parse_course_list(self, response: HtmlResponse):
+        course_list = await funnelback.results(self, response)
         for course in course_list:
             yield scrapy.Request(
                 url=course["liveUrl"],
@@ -375,7 +377,7 @@ class ArtsLondonSpider(scrapy.Spider):
         return modules
 
     def parse_course(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = Document(response, self)
 
         link = response.url
         title = self._get_title(soup)
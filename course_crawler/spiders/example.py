@@ -5,6 +5,7 @@
 
 import os
 import re
+import sys
 from pathlib import Path
 from datetime import datetime
 from typing import List, Optional, Tuple
@@ -18,6 +19,8 @@ from scrapy.http import HtmlResponse
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+from course_crawler.documents import make_soup
+
 
 # TODO: change spider name to match university
 class ExampleSpider(scrapy.Spider):
@@ -58,7 +61,7 @@ class ExampleSpider(scrapy.Spider):
                                  callback=self.parse_course_list)
 
     def parse_course_list(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = make_soup(response, self)
 
         course_list = []
         for url in course_list:
@@ -144,7 +147,7 @@ class ExampleSpider(scrapy.Spider):
         return modules
 
     def parse_course(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = make_soup(response, self)
 
         link = response.url
         title = self._get_title(soup)
@@ -182,5 +185,5 @@ class ExampleSpider(scrapy.Spider):
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(ExampleSpider)  # TODO: change spider name to match university
+    cp.crawl(ExampleSpider, job=sys.argv[1] if len(sys.argv) > 1 else None)  # TODO: change spider name to match university
     cp.start()
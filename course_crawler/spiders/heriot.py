@@ -1,9 +1,9 @@
 from datetime import datetime
 import os
 import re
+import sys
 from pathlib import Path
 from typing import Dict, List
-from urllib.parse import parse_qs
 from bs4 import BeautifulSoup, Tag
 import scrapy
 from scrapy import signals
@@ -11,6 +11,10 @@ from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 from scrapy.http import HtmlResponse
 
+from course_crawler.documents import OptionalRegion, SectionIndex, make_soup
+from course_crawler.extraction import extract
+from course_crawler import funnelback
+
 
 class HeriotSpider(scrapy.Spider):
     name = "heriot"
@@ -26,8 +30,34 @@ class HeriotSpider(scrapy.Spider):
         "FEED_URI": Path(
             f"{output_path}/{name}/"
             f"{name}_graduate_courses_{datetime.today().strftime('%Y-%m-%d')}.json"
-        )
+        ),
+        # course pages are only read through BeautifulSoup, styling is not needed either
+        "PLAYWRIGHT_BLOCKED_RESOURCE_TYPES": ["image", "media", "font", "stylesheet"],
+    }
+    # selectors a plain HTTP response must contain before the browser is skipped
+    required_selectors = {
+        "_parse_course_details_with_soup": ["#course-content"],
     }
+    # incremental discovery (SITEMAP_DISCOVERY_ENABLED)
+    sitemap_urls = ["https://www.hw.ac.uk/sitemap.xml"]
+    sitemap_course_pattern = r"hw\.ac\.uk/.*study/postgraduate/[^?#]+\.htm$"
+    # detail callback that starts a course family for CourseScheduler
+    course_callbacks = ["_parse_course_details_with_soup"]
+    # page regions the course extractors read, the rest of the page is not parsed
+    parse_regions = {
+        "_parse_course_details_with_soup": [
+            "#logoLabel",
+            "dl",
+            "div.pb-5",
+            OptionalRegion("#overview"),
+            OptionalRegion("#entry-requirements"),
+            OptionalRegion("#course-content"),
+            OptionalRegion("table.hw-content-blocks__table"),
+        ],
+    }
+    qualification_pattern = re.compile(
+        r"\s(?:MSc|MA|MBA|MRes|MArch|MDes|MEng|MPhil|LLM|PgDip|PgCert|Postgraduate (?:Diploma|Certificate))(?:\s.*)?$"
+    )
     pattern_ielts = re.compile(r"IELTS\s\d+(\.\d+)?")
     pattern_toefl = re.compile(r"TOEFL\s\d+(\.\d+)?")
     pattern_date = re.compile(
@@ -49,125 +79,53 @@ class HeriotSpider(scrapy.Spider):
         Path(f"{output_path}/{self.name}").mkdir(parents=True, exist_ok=True)
 
     def start_requests(self):
-        url = "https://search.hw.ac.uk/s/search.html?gscope1=uk%2Conline%7C&profile=programmes&f.Level%7Clevel=Postgraduate&collection=heriot-watt%7Esp-programmes"
+        url = "https://search.hw.ac.uk/s/search.json?gscope1=uk%2Conline%7C&profile=programmes&f.Level%7Clevel=Postgraduate&collection=heriot-watt%7Esp-programmes&num_ranks=50&start_rank=1"
         yield scrapy.Request(
             url,
             callback=self.parse,
-            meta=dict(
-                playwright=True,
-                playwright_include_page=True,
-                errback=self.errback,
-            ),
         )
 
-    def parse(self, response: HtmlResponse):
-        # page = response.meta["playwright_page"]
-        # await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
-        courses = self._get_courses(soup)
+    async def parse(self, response: HtmlResponse):
+        courses = await funnelback.results(self, response)
         for course in courses:
-            course_name = self._get_course_name(course)
-            qualification = self._get_qualification(course)
-
-            search_link = self._get_search_link(response, course)
-            level = self._get_level(course)
-            delivery = self._get_all_deliveries(course)
-            location = self._get_location(course)
-
-            if search_link:
-                query = parse_qs(search_link)
-                course_link = next(iter(query["url"]), None)
-                if course_link:
-                    yield scrapy.Request(
-                        course_link,
-                        callback=self._parse_course_details_with_soup,
-                        meta=dict(
-                            playwright=True,
-                            playwright_include_page=True,
-                            errback=self.errback,
-                            course_name=course_name,
-                            course_link=course_link,
-                            level=level,
-                            delivery=delivery,
-                            location=location,
-                            qualification=qualification,
-                        ),
-                    )
-
-        next_page = self._get_next_page(soup)
-
-        if next_page:
-            print(next_page)
+            course_name, qualification = self._get_course_name_and_qualification(course)
+            course_link = course["liveUrl"]
             yield scrapy.Request(
-                response.urljoin(next_page),
+                course_link,
+                callback=self._parse_course_details_with_soup,
+                errback=self.errback,
                 meta=dict(
                     playwright=True,
-                    playwright_include_page=True,
-                    errback=self.errback,
+                    course_name=course_name,
+                    course_link=course_link,
+                    level=self._get_metadata(course, "level"),
+                    delivery=[
+                        delivery.strip()
+                        for delivery in self._get_metadata(course, "delivery").split("|")
+                        if delivery.strip() != ""
+                    ],
+                    location=self._get_metadata(course, "location"),
+                    qualification=qualification,
                 ),
             )
 
-    def _get_next_page(self, soup):
-        try:
-            return soup.select_one(
-                ".hw_course-search__pagination-link.hw_course-search__pagination-link--next"
-            ).get("href")
-        except:
-            return None
+    def _get_metadata(self, course: dict, name: str) -> str:
+        return (course.get("metaData") or {}).get(name, "").strip()
 
-    def _get_courses(self, soup: BeautifulSoup):
-        return soup.select("table .clickable")
-
-    def _get_location(self, course: Tag):
-        try:
-            return course.select_one(".hw_course-search__location").get_text().strip()
-        except:
-            return ""
-
-    def _get_all_deliveries(self, course: Tag) -> List[str]:
-        return [
-            delivery.strip()
-            for delivery in course.select_one(".hw_course-search__delivery")
-            .get_text(separator="\n")
-            .strip()
-            .split("\n")
-            if delivery.strip() != ""
-        ]
-
-    def _get_level(self, course: Tag):
-        try:
-            return course.select_one(".hw_course-search__level").get_text().strip()
-        except:
-            return ""
-
-    def _get_search_link(self, response: HtmlResponse, course: Tag):
-        return response.urljoin(
-            course.select_one(".hw_course-search__subject a").get("href")
-        )
-
-    def _get_qualification(self, course: Tag):
-        return (
-            course.select_one(".hw_course-search__subject a")
-            .contents[-1]
-            .get_text()
-            .replace(">", "")
-            .strip()
-        )
-
-    def _get_course_name(self, course: Tag):
-        try:
-            return (
-                course.select_one(".hw_course-search__subject a strong")
-                .get_text()
-                .strip()
-            )
-        except:
-            return ""
+    def _get_course_name_and_qualification(self, course: dict):
+        # listing titles read "<course name> <award>", e.g. "Actuarial Science MSc"
+        title = course.get("title", "").strip()
+        match = self.qualification_pattern.search(title)
+        if not match:
+            return title, self._get_metadata(course, "award")
+        return title[:match.start()].strip(), match.group(0).strip()
 
     async def _parse_course_details_with_soup(self, response: HtmlResponse):
-        page = response.meta["playwright_page"]
-        await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        for item in await extract(self, response, "_extract_course_details"):
+            yield item
+
+    def _extract_course_details(self, response: HtmlResponse):
+        soup = make_soup(response, self)
         meta_data = self._get_meta_data(soup)
 
         about = self._get_about(soup)
@@ -311,10 +269,13 @@ class HeriotSpider(scrapy.Spider):
     def _get_all_courses(self, soup: BeautifulSoup):
         try:
             courses = []
-            for course in soup.select(
-                "#course-content .tab-switcher__tab .rte-container ul"
-            ):
-                type = course.find_previous(["h3", "h4", "h5", "h6", "p"])
+            content = soup.select_one("#course-content")
+            if content is None:
+                return courses
+            # module types are the headings of the course content, not whatever precedes it
+            sections = SectionIndex(content, type=("h3", "h4", "h5", "h6", "p"))
+            for course in content.select(":scope .tab-switcher__tab .rte-container ul"):
+                type = sections.nearest(course, "type")
                 if type:
                     type = type.get_text().strip()
                     if type.lower().find("option") != -1:
@@ -361,12 +322,13 @@ class HeriotSpider(scrapy.Spider):
         return meta_data
 
     async def errback(self, failure):
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        page = failure.request.meta.get("playwright_page")
+        if page:
+            await page.close()
 
 
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(HeriotSpider)
+    cp.crawl(HeriotSpider, job=sys.argv[1] if len(sys.argv) > 1 else None)
     cp.start()
\ No newline at end of file
@@ -1,16 +1,20 @@
 from datetime import datetime
 import os
 import re
+import sys
 from pathlib import Path
 from typing import Dict, List
 from urllib.parse import parse_qs
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 import scrapy
 from scrapy import signals
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 from scrapy.http import HtmlResponse
-from scrapy_playwright.page import PageMethod
+
+from course_crawler.documents import SectionIndex, make_soup
+from course_crawler.extraction import extract
+from course_crawler.page_methods import record_scroll_result, scroll_until_stable
 
 
 class StrathSpider(scrapy.Spider):
@@ -34,25 +38,16 @@ class StrathSpider(scrapy.Spider):
             f"{name}_graduate_courses_{datetime.today().strftime('%Y-%m-%d')}.json"
         )
     }
+    # region hashed to skip unchanged course pages on the next run
+    content_selectors = {"parse_course": ["main"]}
+    # incremental discovery (SITEMAP_DISCOVERY_ENABLED)
+    sitemap_urls = ["https://www.strath.ac.uk/sitemap.xml"]
+    sitemap_course_pattern = r"strath\.ac\.uk/courses/postgraduatetaught/[^/?#]+/?$"
     pattern_ielts = re.compile(r"IELTS\s\d+(\.\d+)?")
     pattern_toefl = re.compile(r"TOEFL\s\d+(\.\d+)?")
     pattern_date = re.compile(
         r"\b\d{1,2}\s(?:January|February|March|April|May|June|July|August|September|October|November|December)\s\d{4}\b"
     )
-    scrolling_script = """
-    const scrolls = 10
-    let scrollCount = 0
-    
-    // scroll down and then wait for 0.5s
-    const scrollInterval = setInterval(() => {
-      window.scrollTo(0, document.body.scrollHeight)
-      scrollCount++
-    
-      if (scrollCount === numScrolls) {
-        clearInterval(scrollInterval)
-      }
-    }, 2000)
-    """
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -72,25 +67,19 @@ class StrathSpider(scrapy.Spider):
         for url in self.start_urls:
             yield scrapy.Request(
                 url,
+                errback=self.errback,
                 meta=dict(
                     course_link=url,
                     playwright=True,
-                    playwright_include_page=True,
-                    errback=self.errback,
                     playwright_page_methods=[
-                        PageMethod("evaluate", self.scrolling_script),
-                        PageMethod(
-                            "wait_for_selector",
-                            "#course-search-results-show > section:nth-child(238)",
-                        ),
+                        scroll_until_stable("#course-search-results-show > section"),
                     ],
                 ),
             )
 
     async def parse(self, response: HtmlResponse):
-        page = response.meta["playwright_page"]
-        await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        record_scroll_result(self, response.meta["playwright_page_methods"][0])
+        soup = make_soup(response, self)
         courses = soup.select("article a")
         for course in courses:
             link = course.get("href")
@@ -101,10 +90,10 @@ class StrathSpider(scrapy.Spider):
                     yield scrapy.Request(
                         course_link,
                         callback=self.parse_course,
+                        errback=self.errback,
                         meta=dict(
                             # playwright=True,
                             # playwright_include_page=True,
-                            errback=self.errback,
                             course_link=course_link,
                         ),
                     )
@@ -112,7 +101,11 @@ class StrathSpider(scrapy.Spider):
     async def parse_course(self, response: HtmlResponse):
         # page = response.meta["playwright_page"]
         # await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        for item in await extract(self, response, "_extract_course"):
+            yield item
+
+    def _extract_course(self, response: HtmlResponse):
+        soup = make_soup(response, self)
         title = self._get_title(soup)
         description = self._get_description(soup)
         university_title = self.university
@@ -251,11 +244,13 @@ class StrathSpider(scrapy.Spider):
     def _get_modules(self, soup: BeautifulSoup):
         try:
             modules = []
+            sections = SectionIndex(
+                soup, subheader=SoupStrainer("div", class_="course-module-subheader")
+            )
             for i in soup.select("div.course-module-title p"):
                 try:
-                    type = i.findPrevious(
-                        "div", class_="course-module-subheader"
-                    ).prettify()
+                    subheader = sections.nearest(i, "subheader")
+                    type = subheader.prettify()
                     if type.lower().find("<h3>"):
                         if type.lower().find("compulsory") != -1:
                             type = "Compulsory"
@@ -265,8 +260,7 @@ class StrathSpider(scrapy.Spider):
                             type = "Elective"
                         else:
                             type = (
-                                i.findPrevious("div", class_="course-module-subheader")
-                                .findNext("p")
+                                subheader.findNext("p")
                                 .get_text()
                                 .strip()
                             )
@@ -547,12 +541,13 @@ class StrathSpider(scrapy.Spider):
         return language_requirements
 
     async def errback(self, failure):
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        page = failure.request.meta.get("playwright_page")
+        if page:
+            await page.close()
 
 
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(StrathSpider)
+    cp.crawl(StrathSpider, job=sys.argv[1] if len(sys.argv) > 1 else None)
     cp.start()
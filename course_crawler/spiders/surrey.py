@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 from pathlib import Path
 from datetime import datetime
 from typing import List, Optional, Tuple
@@ -13,6 +14,9 @@ from scrapy.http import HtmlResponse
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+from course_crawler.documents import Document, make_soup
+from course_crawler.references import ReferenceResource
+
 
 class SurreySpider(scrapy.Spider):
 
@@ -24,10 +28,21 @@ class SurreySpider(scrapy.Spider):
 
     english_language_certificate_map = {}
 
+    # resolved before the first course page is requested (course_crawler/references.py)
+    reference_resources = [
+        ReferenceResource('english_language_certificate_map',
+                          'https://www.surrey.ac.uk/apply/international/english-language-requirements',
+                          'parse_surrey_english_requirements')
+    ]
+
     start_urls = [
         'https://www.surrey.ac.uk/postgraduate'
     ]
 
+    # incremental discovery (SITEMAP_DISCOVERY_ENABLED)
+    sitemap_urls = ['https://www.surrey.ac.uk/sitemap.xml']
+    sitemap_course_pattern = r'surrey\.ac\.uk/postgraduate/[^/?#]+/?$'
+
     output_path = os.path.join('..', 'data', 'courses', 'output') if os.getcwd().endswith('spiders') \
         else os.path.join('course_crawler', 'data', 'courses', 'output')
 
@@ -49,17 +64,12 @@ class SurreySpider(scrapy.Spider):
         Path(f"{output_path}/{self.name}").mkdir(parents=True, exist_ok=True)
 
     def start_requests(self):
-        # English language requirements
-        yield scrapy.Request(
-            url='https://www.surrey.ac.uk/apply/international/english-language-requirements',
-            callback=self.parse_surrey_english_requirements)
-
         for url in self.start_urls:
             yield scrapy.Request(url=url,
                                  callback=self.parse_course_list)
 
     def parse_surrey_english_requirements(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = make_soup(response, self)
 
         certificates = {}
 
@@ -85,10 +95,10 @@ class SurreySpider(scrapy.Spider):
                     'score': cell
                 })
 
-        self.english_language_certificate_map = certificates
+        return certificates
 
     def parse_course_list(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = make_soup(response, self)
 
         course_list = soup.select('.view-content a')
         for course in course_list:
@@ -147,7 +157,7 @@ class SurreySpider(scrapy.Spider):
     def _get_description(self, soup: BeautifulSoup) -> Optional[str]:
         try:
             what_you_will_study_section = seq(soup.select('h2'))\
-                .find(lambda x: x.text.strip() == 'What you will study').next_sibling
+                .find(lambda x: soup.node_text(x) == 'What you will study').next_sibling
             description = what_you_will_study_section.text.strip().split('.')[0]
         except AttributeError:
             description = None
@@ -156,10 +166,10 @@ class SurreySpider(scrapy.Spider):
     def _get_about(self, soup: BeautifulSoup) -> Optional[str]:
         try:
             why_choose_this_course_section = seq(soup.select('h2')) \
-                .find(lambda x: x.text.strip() == 'Why choose this course').next_sibling
+                .find(lambda x: soup.node_text(x) == 'Why choose this course').next_sibling
 
             what_you_will_study_section = seq(soup.select('h2')) \
-                .find(lambda x: x.text.strip() == 'What you will study').next_sibling
+                .find(lambda x: soup.node_text(x) == 'What you will study').next_sibling
             about = f"{str(why_choose_this_course_section)} {str(what_you_will_study_section)}"
         except AttributeError:
             about = None
@@ -238,7 +248,7 @@ class SurreySpider(scrapy.Spider):
     def _get_entry_requirements(self, soup: BeautifulSoup) -> Optional[str]:
         try:
             entry_requirements_section = seq(soup.select('h2'))\
-                .find(lambda x: x.text.strip() == 'Entry requirements').next_sibling
+                .find(lambda x: soup.node_text(x) == 'Entry requirements').next_sibling
             entry_requirements = " ".join(seq(entry_requirements_section.select('p')).map(lambda x: str(x)))
         except AttributeError:
             entry_requirements = None
@@ -254,11 +264,12 @@ class SurreySpider(scrapy.Spider):
         try:
             english_language_requirements = []
             language_requirements_section = seq(soup.select('h2'))\
-                .find(lambda x: x.text.strip() == 'English language requirements').next_sibling
+                .find(lambda x: soup.node_text(x) == 'English language requirements').next_sibling
 
             ielts_test_title = language_requirements_section.select_one('strong').text.strip().rstrip(':')
 
             language_requirements_section.select_one('strong').decompose()
+            soup.invalidate()
             ielts_test_score = language_requirements_section.select_one('p').text.strip()
 
             english_language_requirements.append({
@@ -294,7 +305,7 @@ class SurreySpider(scrapy.Spider):
         return modules
 
     def parse_course(self, response: HtmlResponse):
-        soup = BeautifulSoup(response.body, 'html.parser', from_encoding='utf-8')
+        soup = Document(response, self)
 
         link = response.url
         title = response.meta['title']
@@ -332,5 +343,5 @@ class SurreySpider(scrapy.Spider):
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(SurreySpider)
+    cp.crawl(SurreySpider, job=sys.argv[1] if len(sys.argv) > 1 else None)
     cp.start()
@@ -1,10 +1,11 @@
 from datetime import datetime
 import os
 import re
+import sys
 from pathlib import Path
 from typing import Dict, List
 from urllib.parse import parse_qs
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 import scrapy
 from scrapy import signals
 from scrapy.crawler import CrawlerProcess
@@ -12,6 +13,10 @@ from scrapy.utils.project import get_project_settings
 from scrapy.http import HtmlResponse
 from scrapy_playwright.page import PageMethod
 
+from course_crawler.documents import Document, make_soup
+from course_crawler.extraction import extract
+from course_crawler.references import ReferenceResource
+
 class SwanseaSpider(scrapy.Spider):
     name = "swansea"
     university="Swansea University"
@@ -31,9 +36,37 @@ class SwanseaSpider(scrapy.Spider):
         "FEED_URI": Path(
             f"{output_path}/{name}/"
             f"{name}_graduate_courses_{datetime.today().strftime('%Y-%m-%d')}.json"
-        )
+        ),
+        # course pages are only read through BeautifulSoup, styling is not needed either
+        "PLAYWRIGHT_BLOCKED_RESOURCE_TYPES": ["image", "media", "font", "stylesheet"],
+    }
+    # selectors a plain HTTP response must contain before the browser is skipped
+    required_selectors = {
+        "parse": ["#app li a"],
+        "parse_course": [".featured-course-content-content-pods"],
+    }
+    # region hashed to skip unchanged course pages on the next run
+    content_selectors = {"parse_course": ["main"]}
+    # headings and blocks a module link is listed under, looked up through Document.sections
+    module_sections = {
+        "variant": SoupStrainer("div", _class="variant"),
+        "degree": "h3",
+        "type": "h5",
     }
     default_application_dates= []
+    # resolved before the first course page is requested (course_crawler/references.py)
+    reference_resources = [
+        ReferenceResource(
+            "ielts_equivalent_score",
+            "https://www.swansea.ac.uk/admissions/english-language-requirements/approved-tests-for-nationals-of-any-country/#d.en.19635",
+            "parse_english_language_requirements",
+        ),
+        ReferenceResource(
+            "default_application_dates",
+            "https://www.swansea.ac.uk/admissions/application-deadlines/",
+            "parse__default_application_dates",
+        ),
+    ]
     ielts_pattern=re.compile(r"IELTS.*?(\d+\.\d+|\d+)")
     toefl_pattern=re.compile(r"TOEFL.*?(\d+\.\d+|\d+)")
     application_dates_pattern=re.compile(r"(\d{1,2}\s(?:January|February|March|April|May|June|July|August|September|October|November|December)\s\d{4})")
@@ -53,25 +86,14 @@ class SwanseaSpider(scrapy.Spider):
         Path(f"{output_path}/{self.name}").mkdir(parents=True, exist_ok=True)
 
     def start_requests(self):
-        language_url="https://www.swansea.ac.uk/admissions/english-language-requirements/approved-tests-for-nationals-of-any-country/#d.en.19635"
-        yield scrapy.Request(
-            language_url,
-            callback=self.parse_english_language_requirements
-        )
-        application_dates_url="https://www.swansea.ac.uk/admissions/application-deadlines/"
-        yield scrapy.Request(
-            application_dates_url,
-            callback=self.parse__default_application_dates
-        )
         for url in self.start_urls:
             yield scrapy.Request(
                 url,
                 callback=self.parse,
+                errback=self.errback,
                 meta=dict(
                     course_link=url,
                     playwright=True,
-                    playwright_include_page=True,
-                    errback=self.errback,
                 ),
             )
         industry_courses_url="https://www.swansea.ac.uk/science-and-engineering/courses/engineering/msc-industry/"
@@ -82,7 +104,7 @@ class SwanseaSpider(scrapy.Spider):
         
     
     def parse_english_language_requirements(self,response: HtmlResponse):
-        soup= BeautifulSoup(response.body,"html.parser", from_encoding="utf-8")
+        soup= make_soup(response, self)
         ielts_equivalent = {"6.0": [], "6.5": [], "7.0": []}  # Initialize the lists
 
         table = soup.select_one("table.mceItemTable")
@@ -102,23 +124,23 @@ class SwanseaSpider(scrapy.Spider):
                         ielts_equivalent["6.5"].append({"language": language, "test": test, "score": score})
                     elif i == 3:
                         ielts_equivalent["7.0"].append({"language": language, "test": test, "score": score})
-        self.ielts_equivalent_score=ielts_equivalent
+        return ielts_equivalent
 
     def parse__default_application_dates(self,response: HtmlResponse):
-        soup= BeautifulSoup(response.body,"html.parser", from_encoding="utf-8")
+        soup= make_soup(response, self)
+        application_dates=[]
         ok=soup.select_one("#d\.en\.163697 h2").find_next("table")
         for i in ok.find_all("td"):
             text=i.text
             date_pattern = re.compile(r"(\d{1,2})\s*(?:st|nd|rd|th)?\s*(?:January|February|March|April|May|June|July|August|September|October|November|December)\s*(\d{4})")
             match = date_pattern.search(text)
             if match:
-                self.default_application_dates.append({"value": match.group(0)})
+                application_dates.append({"value": match.group(0)})
+        return application_dates
 
 
     async def parse(self, response: HtmlResponse):
-        page = response.meta["playwright_page"]
-        await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = make_soup(response, self)
         courses=soup.select("#app li a")
         for course in courses:
             link=course.get("href")
@@ -132,10 +154,9 @@ class SwanseaSpider(scrapy.Spider):
                     yield scrapy.Request(
                         course_link,
                         callback=self.parse_course,
+                        errback=self.errback,
                         meta=dict(
                             playwright=True,
-                            playwright_include_page=True,
-                            errback=self.errback,
                             course_link=course_link,
                             title=title,
                             qualification=qualification,
@@ -143,7 +164,7 @@ class SwanseaSpider(scrapy.Spider):
                     )
     
     def parse_industry_courses(self,response: HtmlResponse):
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        soup = make_soup(response, self)
         courses= soup.select("a.su-image")
         for course in courses:
             if(course["href"].find("youtu.be")==-1):
@@ -154,10 +175,9 @@ class SwanseaSpider(scrapy.Spider):
                 yield scrapy.Request(
                     course_link,
                     callback=self.parse_course,
+                    errback=self.errback,
                     meta=dict(
                         playwright=True,
-                        playwright_include_page=True,
-                        errback=self.errback,
                         course_link=course_link,
                         title=title,
                         qualification=qualification,
@@ -165,9 +185,11 @@ class SwanseaSpider(scrapy.Spider):
                 )
                 
     async def parse_course(self, response: HtmlResponse):
-        page = response.meta["playwright_page"]
-        await page.close()
-        soup = BeautifulSoup(response.body, "html.parser", from_encoding="utf-8")
+        for item in await extract(self, response, "_extract_course"):
+            yield item
+
+    def _extract_course(self, response: HtmlResponse):
+        soup = Document(response, self)
         description = self._get_description(soup)
         university_title = self.university
         application_dates=self._get_application_dates(soup)
@@ -304,22 +326,24 @@ class SwanseaSpider(scrapy.Spider):
         try:
             modules=[]
             subjects=soup.select(".ppsm-ms-moduleTitle a")
+            sections=soup.sections(**self.module_sections)
             for subject in subjects:
                 try:
-                    selector=subject.find_previous("div",_class="variant")
+                    selector=sections.nearest(subject,"variant")
                     qualification_checker=selector.select_one("h3").text.strip().lower()
                     if(qualification_checker.find(qualification.lower())!=-1):
                         title=subject.text.strip()
                         link=subject.get("href")
-                        if(subject.findPrevious("h5").text.lower().find("optional")!=-1):
+                        heading=sections.nearest(subject,"type").text.lower()
+                        if(heading.find("optional")!=-1):
                             type="Optional"
-                        elif(subject.findPrevious("h5").text.lower().find("compulsory")!=-1):
+                        elif(heading.find("compulsory")!=-1):
                             type="Compulsory"
-                        elif(subject.findPrevious("h5").text.lower().find("core")!=-1):
+                        elif(heading.find("core")!=-1):
                             type="Core"
                         else:
                             type="Compulsory"
-                        degree=subject.find_previous("h3").text.strip()
+                        degree=sections.nearest(subject,"degree").text.strip()
                         if(multiple):
                             if(title!=""):
                                 if degree.lower().find(qualification.lower())!=-1:
@@ -331,15 +355,16 @@ class SwanseaSpider(scrapy.Spider):
                 except AttributeError:
                     title=subject.text.strip()
                     link=subject.get("href")
-                    if(subject.findPrevious("h5").text.lower().find("optional")!=-1):
+                    heading=sections.nearest(subject,"type").text.lower()
+                    if(heading.find("optional")!=-1):
                         type="Optional"
-                    elif(subject.findPrevious("h5").text.lower().find("compulsory")!=-1):
+                    elif(heading.find("compulsory")!=-1):
                         type="Compulsory"
-                    elif(subject.findPrevious("h5").text.lower().find("core")!=-1):
+                    elif(heading.find("core")!=-1):
                         type="Core"
                     else:
                         type="Compulsory"
-                    degree=subject.find_previous("h3").text.strip()
+                    degree=sections.nearest(subject,"degree").text.strip()
                     if(multiple):
                         if(title!=""):
                             if degree.lower().find(qualification.lower())!=-1:
@@ -417,12 +442,13 @@ class SwanseaSpider(scrapy.Spider):
         return language_requirements
     
     async def errback(self, failure):
-        page = failure.request.meta["playwright_page"]
-        await page.close()
+        page = failure.request.meta.get("playwright_page")
+        if page:
+            await page.close()
        
 
 if __name__ == "__main__":
     cp = CrawlerProcess(get_project_settings())
 
-    cp.crawl(SwanseaSpider)
+    cp.crawl(SwanseaSpider, job=sys.argv[1] if len(sys.argv) > 1 else None)
     cp.start()
\ No newline at end of file
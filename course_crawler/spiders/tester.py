@@ -221,11 +221,12 @@ def _get_tuitions(soup: BeautifulSoup, parsed_qualification: str, multiple: bool
         return []
     return tuitions
 
-url = 'https://www.strath.ac.uk/courses/postgraduatetaught/appliedtranslationinterpreting/'
+if __name__ == "__main__":
+    url = 'https://www.strath.ac.uk/courses/postgraduatetaught/appliedtranslationinterpreting/'
 
-response = requests.get(url)
-soup = BeautifulSoup(response.content, "html.parser", from_encoding="utf-8")
-tuitions = _get_tuitions(soup,"MSc", True)
-print(tuitions)
+    response = requests.get(url)
+    soup = BeautifulSoup(response.content, "html.parser", from_encoding="utf-8")
+    tuitions = _get_tuitions(soup,"MSc", True)
+    print(tuitions)
 
-# print(json.dumps(tuitions))
+    # print(json.dumps(tuitions))
@@ -0,0 +1,66 @@
+# Sub-requests awaited from inside async spider callbacks
+#
+# The requests are handed straight to the engine's downloader, so they go through the
+# downloader middlewares (retries, redirects, throttling, cache) without being scheduled
+# and a callback can join their responses into the item it is building instead of
+# blocking the reactor with a synchronous HTTP client.
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/coroutines.html
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Iterable, List, Optional
+
+from scrapy import Spider
+from scrapy.crawler import Crawler
+from scrapy.http import Request, Response
+from scrapy.utils.defer import maybe_deferred_to_future
+
+
+async def fetch(spider: Spider, request: Request) -> Response:
+    """Downloads `request` and returns its response, raising the download error if it fails."""
+    return await maybe_deferred_to_future(spider.crawler.engine.download(request))
+
+
+async def fetch_all(spider: Spider, requests: Iterable[Request]) -> List[Optional[Response]]:
+    """
+    Downloads `requests` concurrently and returns their responses in the same order.
+    Downloads that fail or come back with a non-2xx status are logged and returned as None.
+    """
+    requests = list(requests)
+    results = await asyncio.gather(
+        *(fetch(spider, request) for request in requests), return_exceptions=True
+    )
+
+    stats = spider.crawler.stats
+    responses = []
+    for request, result in zip(requests, results):
+        stats.inc_value('subrequests/count', spider=spider)
+        if isinstance(result, BaseException):
+            stats.inc_value('subrequests/failed', spider=spider)
+            spider.logger.warning('Sub-request %s failed: %r', request.url, result)
+            result = None
+        elif not 200 <= result.status < 300:
+            stats.inc_value(f"subrequests/status/{result.status}", spider=spider)
+            spider.logger.debug('Ignoring sub-request %s with status %i', request.url, result.status)
+            result = None
+        responses.append(result)
+    return responses
+
+
+@asynccontextmanager
+async def engine_paused(crawler: Crawler):
+    """
+    Keeps the engine from pulling start requests or scheduled requests while the block runs,
+    e.g. to load data a spider depends on at spider_opened; `fetch` and `fetch_all` still work.
+    Overlapping holds are counted, the engine resumes when the last one ends.
+    """
+    engine = crawler.engine
+    engine._course_crawler_holds = getattr(engine, '_course_crawler_holds', 0) + 1
+    engine.pause()
+    try:
+        yield
+    finally:
+        engine._course_crawler_holds -= 1
+        if not engine._course_crawler_holds:
+            engine.unpause()
@@ -0,0 +1,12 @@
+# Helpers shared by the middlewares, the scheduler and the document layer
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/request-response.html
+from scrapy import Request
+
+
+def callback_name(request: Request) -> str:
+    """The name of `request`'s callback, the key of the per-callback spider attributes
+    (`required_selectors`, `content_selectors`, `parse_regions`, `course_callbacks`, ...)."""
+    callback = request.callback
+    return callback if isinstance(callback, str) else getattr(callback, '__name__', 'parse')
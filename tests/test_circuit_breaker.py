@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+from scrapy import Request, Spider
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.test import get_crawler
+
+from course_crawler.middlewares import CLOSED, HALF_OPEN, OPEN, CircuitBreakerMiddleware
+
+DOMAIN = 'www.example.ac.uk'
+
+
+def _middleware():
+    crawler = get_crawler(Spider, {
+        'CIRCUIT_BREAKER_ENABLED': True,
+        'CIRCUIT_BREAKER_WINDOW': 4,
+        'CIRCUIT_BREAKER_MIN_REQUESTS': 4,
+        'CIRCUIT_BREAKER_FAILURE_RATIO': 0.5,
+        'CIRCUIT_BREAKER_BACKOFF': 30,
+    })
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(
+        _get_slot_key=lambda request, spider: urlparse_cached(request).hostname,
+    ))
+    return CircuitBreakerMiddleware.from_crawler(crawler), crawler._create_spider('courses')
+
+
+def _request(number):
+    return Request(f"https://{DOMAIN}/courses/{number}")
+
+
+def _download(middleware, spider, request, status):
+    response = HtmlResponse(request.url, status=status, request=request)
+    return middleware.process_response(request, response, spider)
+
+
+def _wait(middleware, spider, request):
+    """Sends `request` to an open circuit, returns whether it has been let through so far."""
+    released = []
+    middleware.process_request(request, spider).addCallback(released.append)
+    return released
+
+
+def _opened(middleware, spider):
+    for number in range(4):
+        request = _request(number)
+        assert middleware.process_request(request, spider) is None
+        _download(middleware, spider, request, 503)
+    circuit = middleware.circuits[DOMAIN]
+    assert circuit.state == OPEN and circuit.timer.active()
+    return circuit
+
+
+def test_probe_failure_opens_the_circuit_again_for_longer():
+    middleware, spider = _middleware()
+    circuit = _opened(middleware, spider)
+    probe, waiting = _request('probe'), _request('waiting')
+    probe_released = _wait(middleware, spider, probe)
+    waiting_released = _wait(middleware, spider, waiting)
+    assert not probe_released
+
+    circuit.timer.cancel()
+    middleware._half_open(circuit, spider)
+    assert circuit.state == HALF_OPEN and circuit.probe is probe
+    assert probe_released == [None] and not waiting_released
+    # a request coming in while the probe is out waits as well
+    late_released = _wait(middleware, spider, _request('late'))
+
+    _download(middleware, spider, probe, 503)
+    # the backoff doubles with every consecutive opening
+    assert circuit.state == OPEN and circuit.openings == 2 and circuit.timer.active()
+    assert not waiting_released and not late_released
+    middleware.spider_closed(spider)
+    assert spider.crawler.stats.get_value('circuit_breaker/opened') == 2
+
+
+def test_probe_success_closes_the_circuit_and_releases_the_waiting_requests():
+    middleware, spider = _middleware()
+    circuit = _opened(middleware, spider)
+    probe = _request('probe')
+    _wait(middleware, spider, probe)
+    waiting = [_wait(middleware, spider, _request(number)) for number in range(5, 8)]
+
+    circuit.timer.cancel()
+    middleware._half_open(circuit, spider)
+    _download(middleware, spider, probe, 200)
+    assert circuit.state == CLOSED and circuit.openings == 0
+    assert all(released == [None] for released in waiting)
+    assert middleware.process_request(_request('next'), spider) is None
+
+
+def test_dropped_probe_hands_over_to_the_next_waiting_request():
+    middleware, spider = _middleware()
+    circuit = _opened(middleware, spider)
+    probe, successor = _request('probe'), _request('successor')
+    _wait(middleware, spider, probe)
+    successor_released = _wait(middleware, spider, successor)
+
+    circuit.timer.cancel()
+    middleware._half_open(circuit, spider)
+    middleware.process_exception(probe, IgnoreRequest(), spider)
+    assert circuit.probe is successor and successor_released == [None]
+    # outcomes of requests other than the probe do not move a half-open circuit
+    _download(middleware, spider, _request(1), 200)
+    assert circuit.state == HALF_OPEN
+    _download(middleware, spider, successor, 200)
+    assert circuit.state == CLOSED
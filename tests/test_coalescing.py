@@ -0,0 +1,68 @@
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
+
+from course_crawler.middlewares import CoalescingMiddleware
+
+COURSE = 'https://www.example.ac.uk/courses/finance'
+
+
+def _middleware():
+    crawler = get_crawler(Spider, {'COALESCING_ENABLED': True})
+    return CoalescingMiddleware.from_crawler(crawler), crawler._create_spider('courses')
+
+
+def _follow(middleware, spider, request):
+    """Sends `request` in behind a download of the same page, returns where its outcome lands."""
+    outcomes = []
+    deferred = middleware.process_request(request, spider)
+    assert deferred is not None
+    deferred.addBoth(outcomes.append)
+    return outcomes
+
+
+def test_followers_get_the_response_bound_to_their_own_request():
+    middleware, spider = _middleware()
+    leader = Request(COURSE, dont_filter=True, meta={'course_link': COURSE, 'listing': 1})
+    follower = Request(COURSE, dont_filter=True, meta={'course_link': COURSE, 'listing': 2})
+    assert middleware.process_request(leader, spider) is None
+    outcomes = _follow(middleware, spider, follower)
+    assert follower.meta['download_coalesced']
+
+    response = HtmlResponse(COURSE, body=b'<html></html>', request=leader)
+    assert middleware.process_response(leader, response, spider) is response
+    [shared] = outcomes
+    assert shared.request is follower
+    assert shared.meta['listing'] == 2
+    assert 'coalesced' in shared.flags and 'coalesced' not in response.flags
+    assert spider.crawler.stats.get_value('coalescing/saved') == 1
+
+
+def test_download_error_fans_out_to_every_follower():
+    middleware, spider = _middleware()
+    leader = Request(COURSE, dont_filter=True)
+    assert middleware.process_request(leader, spider) is None
+    outcomes = [_follow(middleware, spider, Request(COURSE, dont_filter=True)) for _ in range(2)]
+
+    error = TimeoutError()
+    assert middleware.process_exception(leader, error, spider) is None
+    for [failure] in outcomes:
+        assert isinstance(failure, Failure) and failure.value is error
+        failure.trap(TimeoutError)
+
+    # the failed download is no longer in flight, its retry downloads again
+    retry = Request(COURSE, dont_filter=True, meta={'download_coalesced': True})
+    assert middleware.process_request(retry, spider) is None
+    assert 'download_coalesced' not in retry.meta
+
+
+def test_rendered_and_page_requests_are_not_shared():
+    middleware, spider = _middleware()
+    assert middleware.process_request(Request(COURSE, dont_filter=True), spider) is None
+    # the rendering mode is part of the key
+    assert middleware.process_request(Request(COURSE, dont_filter=True, meta={'playwright': True}), spider) is None
+    # the callback gets its own Playwright page
+    page = Request(COURSE, dont_filter=True, meta={'playwright': True, 'playwright_include_page': True})
+    assert middleware.process_request(page, spider) is None
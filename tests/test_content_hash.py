@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+
+from course_crawler.middlewares import ContentHashMiddleware, ContentUnchanged
+from course_crawler.spiders.strath import StrathSpider
+
+COURSE = 'https://www.strath.ac.uk/courses/postgraduatetaught/finance/'
+
+
+class Page:
+    """The part of a Playwright page the spider errbacks use."""
+
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def _middleware(tmp_path):
+    crawler = get_crawler(StrathSpider, {'CONTENT_HASH_ENABLED': True, 'CONTENT_HASH_DIR': str(tmp_path)})
+    spider = crawler._create_spider()
+    middleware = ContentHashMiddleware.from_crawler(crawler)
+    middleware.spider_opened(spider)
+    return middleware, spider
+
+
+def _response(spider, footer, page=None):
+    request = Request(COURSE, callback=spider.parse_course, errback=spider.errback,
+                      meta={'course_link': COURSE, 'playwright_page': page})
+    body = f'<html><main><h1>Finance MSc</h1></main><footer>{footer}</footer></html>'
+    return HtmlResponse(COURSE, body=body.encode(), request=request)
+
+
+def _errback(response, failure):
+    # what Scrapy does with an exception raised by a spider middleware's process_spider_input
+    failure.request = response.request
+    return arg_to_iter(asyncio.run(response.request.errback(failure)))
+
+
+def test_unchanged_course_page_is_short_circuited(tmp_path):
+    middleware, spider = _middleware(tmp_path)
+    items = [{'title': 'Finance MSc', 'qualification': 'MSc'}]
+
+    first = _response(spider, footer='October')
+    assert middleware.process_spider_input(first, spider) is None
+    assert list(middleware.process_spider_output(first, items, spider)) == items
+
+    # only the footer changed, the content region did not
+    page = Page()
+    second = _response(spider, footer='November', page=page)
+    with pytest.raises(ContentUnchanged) as unchanged:
+        middleware.process_spider_input(second, spider)
+    output = _errback(second, Failure(unchanged.value))
+    assert list(middleware.process_spider_output(second, output, spider)) == items
+    assert page.closed
+
+    stats = spider.crawler.stats
+    assert stats.get_value('content_hash/unchanged') == 1
+    assert stats.get_value('content_hash/stored') == 1
+    assert 'content_unchanged' not in second.meta
+
+
+def test_changed_course_page_is_extracted_again(tmp_path):
+    middleware, spider = _middleware(tmp_path)
+    first = _response(spider, footer='October')
+    middleware.process_spider_input(first, spider)
+    list(middleware.process_spider_output(first, [{'title': 'Finance MSc'}], spider))
+
+    request = first.request
+    changed = HtmlResponse(COURSE, body=b'<html><main><h1>Finance MSc (online)</h1></main></html>', request=request)
+    assert middleware.process_spider_input(changed, spider) is None
+    assert spider.crawler.stats.get_value('content_hash/changed') == 1
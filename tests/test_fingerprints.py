@@ -0,0 +1,74 @@
+import hashlib
+
+from course_crawler.fingerprints import FINGERPRINT_SIZE, FingerprintStore
+
+
+def _fp(number):
+    return hashlib.sha1(str(number).encode()).digest()
+
+
+def _crash(store):
+    """Drops `store` the way a killed process does: the log is written, nothing else is saved."""
+    store.log.close()
+    store.index.close()
+    store.index_file.close()
+
+
+def _store(tmp_path, **kwargs):
+    return FingerprintStore(tmp_path / 'requests', **kwargs)
+
+
+def test_reopened_store_keeps_its_fingerprints(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    # enough to grow the table past its first size
+    assert all(store.add(_fp(number)) for number in range(3000))
+    assert not store.add(_fp(7))
+    store.close()
+
+    rebuilds = []
+    monkeypatch.setattr(FingerprintStore, '_rebuild_index', lambda self, slots: rebuilds.append(slots))
+    store = _store(tmp_path)
+    assert not rebuilds
+    assert len(store) == 3000
+    assert all(_fp(number) in store for number in range(3000))
+    assert _fp(3000) not in store
+    store.close()
+
+
+def test_store_recovers_from_a_crash(tmp_path):
+    store = _store(tmp_path)
+    for number in range(1500):
+        store.add(_fp(number))
+    store.close()
+    store = _store(tmp_path)
+    for number in range(1500, 2000):
+        store.add(_fp(number))
+    _crash(store)
+    # a record cut short by the crash
+    with (tmp_path / 'requests.log').open('ab') as f:
+        f.write(_fp(2000)[:7])
+
+    store = _store(tmp_path)
+    assert len(store) == 2000
+    assert (tmp_path / 'requests.log').stat().st_size == 2000 * FINGERPRINT_SIZE
+    assert all(_fp(number) in store for number in range(2000))
+    assert _fp(2000) not in store
+    assert store.add(_fp(2000))
+    assert not store.add(_fp(1999))
+    store.close()
+
+
+def test_index_and_filter_are_rebuilt_from_the_log(tmp_path):
+    store = _store(tmp_path, capacity=100)
+    for number in range(300):
+        store.add(_fp(number))
+    store.close()
+    (tmp_path / 'requests.idx').unlink()
+    (tmp_path / 'requests.bloom').write_bytes(b'torn')
+
+    # the filter is sized for the fingerprints the log outgrew it with
+    store = _store(tmp_path, capacity=100)
+    assert store.capacity >= 600
+    assert all(_fp(number) in store for number in range(300))
+    assert sum(_fp(number) in store.bloom for number in range(300, 1300)) < 50
+    store.close()
@@ -0,0 +1,105 @@
+from threading import Lock
+
+from scrapy import Request, Spider, signals
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from course_crawler.jobs import ResumableJobMiddleware
+
+LISTING = 'https://www.example.ac.uk/courses/'
+
+
+class CourseSpider(Spider):
+    name = 'courses'
+    start_urls = [LISTING]
+
+    def parse_course(self, response):
+        pass
+
+
+def _middleware(tmp_path):
+    """The middleware of a (re)run of job `job`, with the items item_scraped sends collected."""
+    crawler = get_crawler(CourseSpider, {'CRAWL_JOB_DIR': str(tmp_path), 'CRAWL_JOB_ID': 'job'})
+    crawler.spider = spider = crawler._create_spider()
+    scraped = []
+    crawler.signals.connect(lambda item, response, spider: scraped.append(item), signal=signals.item_scraped, weak=False)
+    middleware = ResumableJobMiddleware.from_crawler(crawler)
+    middleware.spider_opened(spider)
+    return middleware, spider, scraped
+
+
+def _crawl(middleware, spider, response, output):
+    """Hands `output` from the callback of `response` through the middleware, as the scraper would:
+    each request is scheduled as soon as it comes out, before the response is completed."""
+    result = []
+    for element in middleware.process_spider_output(response, output, spider):
+        result.append(element)
+        if isinstance(element, Request):
+            middleware.request_scheduled(element, spider)
+        else:
+            spider.crawler.signals.send_catch_log(signals.item_scraped, item=element, response=response, spider=spider)
+    return result
+
+
+def _response(request):
+    return HtmlResponse(request.url, body=b'<html></html>', request=request)
+
+
+def _course(spider, name, **meta):
+    return Request(f"{LISTING}{name}", callback=spider.parse_course, meta=meta)
+
+
+def test_resumed_job_schedules_pending_requests_and_replays_items(tmp_path):
+    middleware, spider, _ = _middleware(tmp_path)
+    listing = next(iter(middleware.process_start_requests(spider.start_requests(), spider)))
+    middleware.request_scheduled(listing, spider)
+    finance, law = _crawl(middleware, spider, _response(listing), [_course(spider, 'finance'), _course(spider, 'law')])
+    _crawl(middleware, spider, _response(finance), [{'title': 'Finance MSc'}])
+    # killed while law was being parsed: its item was scraped, its response never completed
+    spider.crawler.signals.send_catch_log(signals.item_scraped, item={'title': 'Law LLM'}, response=_response(law), spider=spider)
+    middleware.spider_closed(spider, 'shutdown')
+
+    middleware, spider, scraped = _middleware(tmp_path)
+    assert middleware.resuming
+    assert scraped == [{'title': 'Finance MSc'}]
+    resumed = list(middleware.process_start_requests(spider.start_requests(), spider))
+    assert [request.url for request in resumed] == [law.url]
+    assert resumed[0].callback == spider.parse_course
+    # the listing yields the courses again on its own rerun, the completed one is dropped
+    assert _crawl(middleware, spider, _response(listing), [finance.copy(), law.copy()])[0].url == law.url
+
+    middleware.spider_closed(spider, 'finished')
+    assert not middleware.journal.path.exists()
+
+
+def test_response_with_unjournaled_request_is_crawled_again(tmp_path):
+    middleware, spider, _ = _middleware(tmp_path)
+    listing = next(iter(middleware.process_start_requests(spider.start_requests(), spider)))
+    middleware.request_scheduled(listing, spider)
+    # a live object in meta cannot be pickled
+    _crawl(middleware, spider, _response(listing), [_course(spider, 'finance', lock=Lock())])
+    assert spider.crawler.stats.get_value('jobs/unserializable') == 1
+    middleware.spider_closed(spider, 'shutdown')
+
+    middleware, spider, _ = _middleware(tmp_path)
+    resumed = list(middleware.process_start_requests(spider.start_requests(), spider))
+    assert [request.url for request in resumed] == [LISTING]
+
+
+def test_items_of_a_job_are_replayed_once(tmp_path):
+    middleware, spider, _ = _middleware(tmp_path)
+    listing = next(iter(middleware.process_start_requests(spider.start_requests(), spider)))
+    middleware.request_scheduled(listing, spider)
+    finance, law = _crawl(middleware, spider, _response(listing), [_course(spider, 'finance'), _course(spider, 'law')])
+    _crawl(middleware, spider, _response(finance), [{'title': 'Finance MSc'}])
+    middleware.spider_closed(spider, 'shutdown')
+
+    # killed again after the resumed run parsed the other course
+    middleware, spider, scraped = _middleware(tmp_path)
+    law = next(iter(middleware.process_start_requests([], spider)))
+    _crawl(middleware, spider, _response(law), [{'title': 'Law LLM'}])
+    middleware.spider_closed(spider, 'shutdown')
+
+    middleware, spider, scraped = _middleware(tmp_path)
+    assert scraped == [{'title': 'Finance MSc'}, {'title': 'Law LLM'}]
+    assert list(middleware.process_start_requests(spider.start_requests(), spider)) == []
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+from scrapy import Request, Spider
+from scrapy.core.scraper import Slot
+from scrapy.utils.test import get_crawler
+
+from course_crawler.scheduler import DETAIL, CourseScheduler
+
+
+class Engine:
+    """The parts of the engine and scraper slots CourseScheduler looks at."""
+
+    def __init__(self):
+        self.slot = SimpleNamespace(inprogress=set())
+        self.scraper = SimpleNamespace(slot=Slot())
+        self.downloader = SimpleNamespace(active=set())
+
+    def download(self, request, coalesced=False):
+        self.slot.inprogress.add(request)
+        if not coalesced:
+            self.downloader.active.add(request)
+
+    def scrape(self, request):
+        # the download finished, its response or failure goes to the scraper
+        self.slot.inprogress.discard(request)
+        self.downloader.active.discard(request)
+        self.scraper.slot.active.add(request)
+
+    def finish(self, request):
+        self.slot.inprogress.discard(request)
+        self.downloader.active.discard(request)
+        self.scraper.slot.active.discard(request)
+
+
+def _scheduler(max_open_families=1):
+    crawler = get_crawler(Spider, {
+        'SCHEDULER_MAX_OPEN_FAMILIES': max_open_families,
+        'SCHEDULER_KIND_PRIORITY': {'listing': 0, 'detail': 10, 'sub': 20},
+    })
+    crawler.engine = Engine()
+    scheduler = CourseScheduler.from_crawler(crawler)
+    scheduler.open(Spider('courses'))
+    return scheduler, crawler.engine
+
+
+def _detail(url, family):
+    return Request(url, dont_filter=True, meta={'request_kind': DETAIL, 'course_family': family})
+
+
+def _next(scheduler, engine, coalesced=False):
+    request = scheduler.next_request()
+    if request is not None:
+        engine.download(request, coalesced)
+    return request
+
+
+def test_coalesced_request_closes_its_family():
+    scheduler, engine = _scheduler()
+    first = _detail('https://www.example.ac.uk/course', 1)
+    second = _detail('https://www.example.ac.uk/course', 1)
+    other = _detail('https://www.example.ac.uk/other', 2)
+    for request in (first, second, other):
+        assert scheduler.enqueue_request(request)
+    assert list(scheduler.parked) == [other]
+
+    # the second copy waits for the first one's download and never reaches the downloader
+    leader = _next(scheduler, engine)
+    follower = _next(scheduler, engine, coalesced=True)
+    assert {id(leader), id(follower)} == {id(first), id(second)}
+    engine.scrape(leader)
+    engine.scrape(follower)
+    assert _next(scheduler, engine) is None
+    assert set(scheduler.open_families) == {1}
+
+    engine.finish(leader)
+    engine.finish(follower)
+    assert _next(scheduler, engine) is other
+    assert set(scheduler.open_families) == {2}
+
+
+def test_ignored_request_closes_its_family():
+    scheduler, engine = _scheduler()
+    ignored = _detail('https://www.example.ac.uk/ignored', 1)
+    other = _detail('https://www.example.ac.uk/other', 2)
+    scheduler.enqueue_request(ignored)
+    scheduler.enqueue_request(other)
+
+    assert _next(scheduler, engine) is ignored
+    # IgnoreRequest from a downloader middleware: out of the engine without a response
+    engine.finish(ignored)
+    assert _next(scheduler, engine) is other
+    assert set(scheduler.open_families) == {2}
+
+
+def test_family_stays_open_while_its_response_is_parsed():
+    scheduler, engine = _scheduler()
+    detail = _detail('https://www.example.ac.uk/course', 1)
+    other = _detail('https://www.example.ac.uk/other', 2)
+    scheduler.enqueue_request(detail)
+    scheduler.enqueue_request(other)
+
+    assert _next(scheduler, engine) is detail
+    engine.scrape(detail)
+    sub = Request('https://www.example.ac.uk/course/fees', meta={'request_kind': 'sub', 'course_family': 1})
+    scheduler.enqueue_request(sub)
+    engine.finish(detail)
+
+    assert _next(scheduler, engine) is sub
+    assert _next(scheduler, engine) is None
+    engine.finish(sub)
+    assert _next(scheduler, engine) is other